@@ -0,0 +1,80 @@
+# Scaling of distributed.Coordinator with the number of worker processes on this
+# machine. For every worker count the same frame is rendered twice: the first render
+# includes starting the workers and sending them the scene, the second one is tiles
+# only and gives the speedup over the first worker count. With --kill one worker is
+# killed that many seconds into the first render, the others pick up its tiles.
+# Run from the repository root:
+#
+#     python -m benchmarks.distributed_bench --workers 1,2,4 --resolution 320x240
+import io
+import time
+import argparse
+import threading
+import contextlib
+import multiprocessing
+
+import distributed
+
+from renderer import Renderer
+
+from benchmarks import scenes
+
+
+def run(scene, width, height, options, count, kill=None):
+    # returns (first render, second render, tiles requeued) seconds
+    context = multiprocessing.get_context('spawn')
+
+    with distributed.Coordinator(Renderer(width, height, options)) as coordinator:
+        processes = [context.Process(target=distributed.run_worker, args=(coordinator.address,))
+                     for _ in range(count)]
+        for process in processes:
+            process.start()
+
+        if kill is not None:
+            threading.Timer(kill, processes[0].kill).start()
+
+        with contextlib.redirect_stdout(io.StringIO()):
+            start = time.perf_counter()
+            coordinator.render(scene)
+            first = time.perf_counter() - start
+            requeued = coordinator.report['requeued']
+
+            start = time.perf_counter()
+            coordinator.render(scene)
+            second = time.perf_counter() - start
+
+    for process in processes:
+        process.join()
+
+    return first, second, requeued
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Distributed render scaling benchmark')
+    parser.add_argument('--scene', default='main', choices=sorted(scenes.SCENES))
+    parser.add_argument('--resolution', default='320x240')
+    parser.add_argument('--engine', default='packet')
+    parser.add_argument('--tile-size', type=int, default=32)
+    parser.add_argument('--workers', default='1,2,4')
+    parser.add_argument('--kill', type=float, default=None)
+    args = parser.parse_args(argv)
+
+    width, height = (int(value) for value in args.resolution.split('x'))
+    options = {'engine': args.engine, 'tile_size': args.tile_size}
+
+    with contextlib.redirect_stdout(io.StringIO()):
+        scene = scenes.SCENES[args.scene](scenes.asset_cache())
+
+    print('%-8s %12s %12s %9s %11s %9s' % ('workers', 'first', 'render', 'speedup', 'efficiency', 'requeued'))
+    baseline = None
+    for count in (int(value) for value in args.workers.split(',')):
+        first, second, requeued = run(scene, width, height, options, count, args.kill)
+        baseline = baseline or (count, second)
+        speedup = baseline[1] / second
+
+        print('%-8d %11.3fs %11.3fs %8.2fx %10.0f%% %9d' % (
+            count, first, second, speedup, 100 * speedup * baseline[0] / count, requeued), flush=True)
+
+
+if __name__ == '__main__':
+    main()
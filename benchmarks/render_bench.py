@@ -0,0 +1,155 @@
+# End to end render benchmark over the canonical scenes in benchmarks/scenes.py.
+# Every case (scene, resolution, option preset, engine) runs in a fresh process so
+# peak RSS is its own. Results can be saved as JSON and compared against a stored
+# baseline; the run exits with status 1 when a case regressed beyond the threshold.
+# Run from the repository root:
+#
+#     python -m benchmarks.render_bench --output bench.json
+#     python -m benchmarks.render_bench --baseline bench.json --threshold 0.15
+import io
+import sys
+import json
+import time
+import argparse
+import platform
+import resource
+import contextlib
+import multiprocessing
+
+from renderer import Renderer
+
+from benchmarks import scenes
+
+
+PRESETS = {
+    'full': {},
+    'no_secondary': {'reflect': False, 'refract': False},
+    'no_shadow': {'shadow': False},
+    'no_envmap': {'envmap': False},
+}
+
+RESOLUTIONS = ['64x48', '128x96']
+ENGINES = ['scalar', 'packet']
+
+# (metric, True when higher is better)
+GATED_METRICS = [('total_rays_per_sec', True), ('peak_rss_mb', False)]
+
+
+def peak_rss_mb():
+    # ru_maxrss is in kilobytes on linux and bytes on macos
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / (1 << 20) if platform.system() == 'Darwin' else peak / 1024
+
+
+def run_case(case):
+    width, height = (int(value) for value in case['resolution'].split('x'))
+    options = dict(PRESETS[case['preset']], engine=case['engine'])
+
+    with contextlib.redirect_stdout(io.StringIO()):
+        start = time.perf_counter()
+        scene = scenes.SCENES[case['scene']](scenes.asset_cache())
+        scene.prepare()
+        setup_time = time.perf_counter() - start
+
+        renderer = Renderer(width, height, options)
+        wall_time = float('inf')
+        for _ in range(case['repeat']):
+            start = time.perf_counter()
+            renderer.render(scene)
+            wall_time = min(wall_time, time.perf_counter() - start)
+
+    primary_rays = width * height
+    # camera and secondary rays are counted as 'rays', shadow rays on their own
+    total_rays = renderer.ray_counts['rays'] + renderer.ray_counts['shadow']
+
+    return dict(case, **{
+        'setup_time': setup_time,
+        'wall_time': wall_time,
+        'primary_rays': primary_rays,
+        'total_rays': total_rays,
+        'primary_rays_per_sec': primary_rays / wall_time,
+        'total_rays_per_sec': total_rays / wall_time,
+        'peak_rss_mb': peak_rss_mb(),
+    })
+
+
+def case_key(case):
+    return '{scene}/{resolution}/{preset}/{engine}'.format(**case)
+
+
+def compare(results, baseline, threshold):
+    # returns the list of (key, metric, baseline value, new value) that got worse by
+    # more than threshold (a fraction)
+    previous = {case_key(case): case for case in baseline['cases']}
+    regressions = []
+
+    for case in results['cases']:
+        old = previous.get(case_key(case))
+        if old is None:
+            continue
+
+        for metric, higher_is_better in GATED_METRICS:
+            change = (case[metric] - old[metric]) / old[metric] if old[metric] else 0.0
+            if (-change if higher_is_better else change) > threshold:
+                regressions.append((case_key(case), metric, old[metric], case[metric]))
+
+    return regressions
+
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(description='Render benchmark suite')
+    parser.add_argument('--scenes', default=','.join(scenes.SCENES))
+    parser.add_argument('--resolutions', default=','.join(RESOLUTIONS))
+    parser.add_argument('--presets', default=','.join(PRESETS))
+    parser.add_argument('--engines', default=','.join(ENGINES))
+    parser.add_argument('--repeat', type=int, default=1, help='renders per case, the fastest one is kept')
+    parser.add_argument('--output', help='write the results as JSON')
+    parser.add_argument('--baseline', help='JSON results of an earlier run to compare against')
+    parser.add_argument('--threshold', type=float, default=0.1, help='allowed relative regression')
+
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+
+    cases = [
+        {'scene': scene, 'resolution': resolution, 'preset': preset, 'engine': engine, 'repeat': args.repeat}
+        for scene in args.scenes.split(',')
+        for resolution in args.resolutions.split(',')
+        for preset in args.presets.split(',')
+        for engine in args.engines.split(',')
+    ]
+
+    context = multiprocessing.get_context('spawn')
+    results = {'python': platform.python_version(), 'machine': platform.machine(), 'cases': []}
+
+    print('%-40s %9s %12s %12s %9s' % ('case', 'wall s', 'primary/s', 'total/s', 'rss MB'))
+    for case in cases:
+        with context.Pool(1) as pool:
+            result = pool.apply(run_case, (case,))
+
+        results['cases'].append(result)
+        print('%-40s %9.3f %12.0f %12.0f %9.1f' % (
+            case_key(result), result['wall_time'], result['primary_rays_per_sec'],
+            result['total_rays_per_sec'], result['peak_rss_mb']), flush=True)
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = compare(results, json.load(f), args.threshold)
+
+        for key, metric, old, new in regressions:
+            print('REGRESSION %s %s: %.3f -> %.3f' % (key, metric, old, new))
+
+        if regressions:
+            return 1
+
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,158 @@
+# Canonical benchmark scenes. Every builder returns a fresh Scene, random content is
+# seeded so the same scene is rendered on every run
+import os
+import math
+import random
+import tempfile
+
+import main
+
+from cache import AssetCache
+from scene import Scene
+
+from entities import Vector3, Vector4, Sphere, Light, Material, Panel, MeshInstance, Transform, SphereSet
+from entities.objects import Duck
+from entities.model import Model
+from entities.envmap import EnvironmentMap
+
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+IVORY = Material(Vector4(0.6, 0.3, 0.1, 0), Vector3(0.4, 0.4, 0.3), 50.0, 1.0)
+RED_RUBBER = Material(Vector4(0.9, 0.1, 0, 0), Vector3(0.3, 0.1, 0.1), 10.0, 1.0)
+GLASS = Material(Vector4(0.0, 0.5, 0.1, 0.8), Vector3(0.6, 0.7, 0.8), 125.0, 1.5)
+MIRROR = Material(Vector4(0.0, 10.0, 0.8, 0), Vector3(1.0, 1.0, 1.0), 1425.0, 1.0)
+
+
+def asset_cache():
+    return AssetCache(os.path.join(ROOT, '.cache'))
+
+
+def empty_scene(cache):
+    return Scene(EnvironmentMap.open(os.path.join(ROOT, 'envmap.jpg'), cache=cache))
+
+
+def main_scene(cache):
+    # the scene main.py renders
+    scene = empty_scene(cache)
+
+    cwd = os.getcwd()
+    os.chdir(ROOT)
+    try:
+        main.add_lights(scene)
+        main.add_objects(scene, cache)
+    finally:
+        os.chdir(cwd)
+
+    return scene
+
+
+def spheres_scene(cache, count=500, seed=3):
+    # lots of small spheres, stresses the scene level bvh
+    rng = random.Random(seed)
+
+    scene = empty_scene(cache)
+    main.add_lights(scene)
+    scene.add_object(Panel(Vector3(0, -4, -20), 20, 20))
+
+    for _ in range(count):
+        center = Vector3(rng.uniform(-10, 10), rng.uniform(-3, 8), rng.uniform(-30, -10))
+        scene.add_object(Sphere(center, rng.uniform(0.1, 0.5), rng.choice([IVORY, RED_RUBBER, GLASS, MIRROR])))
+
+    return scene
+
+
+def particles_scene(cache, count=10000, seed=11):
+    # a cloud of small spheres in a single SphereSet
+    rng = random.Random(seed)
+
+    scene = empty_scene(cache)
+    main.add_lights(scene)
+    scene.add_object(Panel(Vector3(0, -4, -20), 20, 20))
+
+    centers = [(rng.uniform(-10, 10), rng.uniform(-3, 8), rng.uniform(-30, -10)) for _ in range(count)]
+    radii = [rng.uniform(0.05, 0.2) for _ in range(count)]
+    scene.add_object(SphereSet(centers, radii, [IVORY, RED_RUBBER, GLASS, MIRROR], [rng.randrange(4) for _ in range(count)]))
+
+    return scene
+
+
+def write_uv_sphere(filename, rings, center=(0, 0, -15), radius=3):
+    segments = rings * 2
+    cx, cy, cz = center
+
+    with open(filename, 'w') as f:
+        for i in range(rings + 1):
+            theta = math.pi * i / rings
+            for j in range(segments):
+                phi = 2 * math.pi * j / segments
+                f.write('v %f %f %f\n' % (cx + radius * math.sin(theta) * math.cos(phi),
+                                          cy + radius * math.cos(theta),
+                                          cz + radius * math.sin(theta) * math.sin(phi)))
+
+        for i in range(rings):
+            for j in range(segments):
+                a = i * segments + j + 1
+                b = i * segments + (j + 1) % segments + 1
+                c = (i + 1) * segments + j + 1
+                d = (i + 1) * segments + (j + 1) % segments + 1
+                f.write('f %d %d %d\nf %d %d %d\n' % (a, c, b, b, c, d))
+
+
+def highpoly_scene(cache, rings=160):
+    # a single glass mesh of 4 * rings^2 triangles (~100k by default)
+    filename = os.path.join(tempfile.gettempdir(), 'raytracer-bench-sphere-%d.obj' % rings)
+    if not os.path.exists(filename):
+        write_uv_sphere(filename, rings)
+
+    scene = empty_scene(cache)
+    main.add_lights(scene)
+    scene.add_object(Panel(Vector3(0, -4, -20), 20, 20))
+    scene.add_object(Duck(Vector3(0, 0, -15), Model(filename, cache=cache), GLASS))
+    scene.add_object(Sphere(Vector3(6, 4, -20), 3, MIRROR))
+
+    return scene
+
+
+def many_lights_scene(cache, count=16, seed=5):
+    # the main scene lit by many lights, every hit casts count shadow rays
+    rng = random.Random(seed)
+    scene = main_scene(cache)
+
+    for _ in range(count - len(scene.lights)):
+        position = Vector3(rng.uniform(-40, 40), rng.uniform(10, 50), rng.uniform(-40, 30))
+        scene.add_light(Light(position, rng.uniform(0.1, 0.4)))
+
+    return scene
+
+
+def instances_scene(cache, count=1000, seed=7):
+    # a field of ducks, all instances of one model
+    rng = random.Random(seed)
+    model = Model(os.path.join(ROOT, 'duck.obj'), cache=cache)
+
+    # duck.obj is modelled around (-3, 0, -16), instances are placed relative to that
+    center = Vector3(*((model._vertices.min(axis=0) + model._vertices.max(axis=0)) / 2).tolist())
+    to_origin = Transform.translation(-center)
+
+    scene = empty_scene(cache)
+    main.add_lights(scene)
+    scene.add_object(Panel(Vector3(0, -4, -30), 60, 40))
+
+    for _ in range(count):
+        position = Vector3(rng.uniform(-25, 25), rng.uniform(-3, 6), rng.uniform(-50, -12))
+        transform = (Transform.translation(position) * Transform.rotation(Vector3(0, 1, 0), rng.uniform(0, 6.3))
+                     * Transform.scaling(rng.uniform(0.2, 0.5)) * to_origin)
+        scene.add_object(MeshInstance(model, transform, rng.choice([IVORY, RED_RUBBER, GLASS, MIRROR])))
+
+    return scene
+
+
+SCENES = {
+    'main': main_scene,
+    'spheres': spheres_scene,
+    'highpoly': highpoly_scene,
+    'many_lights': many_lights_scene,
+    'instances': instances_scene,
+    'particles': particles_scene,
+}
@@ -0,0 +1,83 @@
+# Per frame cost of an animation rendered with Renderer.render_sequence against one
+# process per frame (what running main.py for every frame costs: start, load the
+# assets, build the trees, render) and against the bare render of a ready scene.
+# Run from the repository root:
+#
+#     python -m benchmarks.sequence_bench --frames 8 --workers 1,2
+import io
+import time
+import argparse
+import tempfile
+import contextlib
+import multiprocessing
+
+from renderer import Renderer
+
+from entities import Vector3
+
+from benchmarks import scenes
+
+
+def frames(count):
+    # the red sphere rolls to the right while the first light dims
+    for index in range(count):
+        yield {
+            'objects': {4: {'center': Vector3(1.5 + 0.5 * index, -0.5, -18)}},
+            'lights': {0: {'intensity': 1.5 - 0.05 * index}},
+        }
+
+
+def single_frame(width, height, options, index):
+    # a whole run for one frame, meant for a fresh process
+    with contextlib.redirect_stdout(io.StringIO()):
+        scene = scenes.main_scene(scenes.asset_cache())
+        scene.update(**list(frames(index + 1))[index])
+        Renderer(width, height, options).render(scene)
+
+
+def run(width, height, options, count):
+    context = multiprocessing.get_context('spawn')
+
+    start = time.perf_counter()
+    for index in range(count):
+        # not a pool: its daemonic processes could not start render workers
+        process = context.Process(target=single_frame, args=(width, height, options, index))
+        process.start()
+        process.join()
+    per_process = (time.perf_counter() - start) / count
+
+    with contextlib.redirect_stdout(io.StringIO()):
+        scene = scenes.main_scene(scenes.asset_cache())
+        scene.prepare()
+
+        start = time.perf_counter()
+        Renderer(width, height, options).render(scene)
+        trace_only = time.perf_counter() - start
+
+        with tempfile.TemporaryDirectory() as directory:
+            start = time.perf_counter()
+            Renderer(width, height, options).render_sequence(scene, frames(count), directory + '/frame_%04d.ppm')
+            sequence = (time.perf_counter() - start) / count
+
+    return per_process, sequence, trace_only
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Animation render benchmark')
+    parser.add_argument('--resolution', default='128x96')
+    parser.add_argument('--engine', default='packet')
+    parser.add_argument('--workers', default='1')
+    parser.add_argument('--frames', type=int, default=8)
+    args = parser.parse_args(argv)
+
+    width, height = (int(value) for value in args.resolution.split('x'))
+
+    print('%-8s %14s %14s %14s' % ('workers', 'process/frame', 'sequence/frame', 'render()'))
+    for workers in args.workers.split(','):
+        options = {'engine': args.engine, 'workers': int(workers)}
+        per_process, sequence, trace_only = run(width, height, options, args.frames)
+        print('%-8s %13.3fs %13.3fs %13.3fs' % (workers, per_process, sequence, trace_only), flush=True)
+
+
+if __name__ == '__main__':
+    main()
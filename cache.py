@@ -0,0 +1,140 @@
+import os
+import json
+import time
+import shutil
+import hashlib
+
+import numpy as np
+
+
+class AssetCache(object):
+    # on-disk cache of decoded assets (meshes, bvhs, environment maps) stored as raw
+    # .npy arrays and loaded back memory mapped. Entries are keyed by the content hash
+    # of the source file; path, mtime and size only let us skip hashing unchanged files.
+    # Least recently used entries are evicted once the cache grows over max_bytes
+    VERSION = 1
+
+    def __init__(self, directory='.cache', max_bytes=2 << 30):
+        self.directory = directory
+        self.max_bytes = max_bytes
+
+        os.makedirs(directory, exist_ok=True)
+        self._index_path = os.path.join(directory, 'index.json')
+
+    def _read_index(self):
+        try:
+            with open(self._index_path, 'r') as f:
+                index = json.load(f)
+        except (IOError, ValueError):
+            index = {}
+
+        if index.get('version') != self.VERSION:
+            index = {'version': self.VERSION, 'files': {}, 'entries': {}}
+
+        return index
+
+    def _write_index(self, index):
+        tmp_path = '{}.{}.tmp'.format(self._index_path, os.getpid())
+        with open(tmp_path, 'w') as f:
+            json.dump(index, f)
+        os.replace(tmp_path, self._index_path)
+
+    @classmethod
+    def _hash_file(cls, filename):
+        digest = hashlib.blake2b(digest_size=16)
+
+        with open(filename, 'rb') as f:
+            for chunk in iter(lambda: f.read(1 << 20), b''):
+                digest.update(chunk)
+
+        return digest.hexdigest()
+
+    def _content_hash(self, filename, index):
+        path = os.path.abspath(filename)
+        stat = os.stat(path)
+
+        known = index['files'].get(path)
+        if known and known['mtime'] == stat.st_mtime and known['size'] == stat.st_size:
+            return known['hash']
+
+        content_hash = self._hash_file(path)
+        index['files'][path] = {'mtime': stat.st_mtime, 'size': stat.st_size, 'hash': content_hash}
+
+        return content_hash
+
+    def _entry_name(self, filename, kind, index):
+        return '{}-{}'.format(kind, self._content_hash(filename, index))
+
+    def load(self, filename, kind):
+        # returns {name: memory mapped array} or None on a miss
+        index = self._read_index()
+        name = self._entry_name(filename, kind, index)
+        entry = index['entries'].get(name)
+        path = os.path.join(self.directory, name)
+
+        if entry is None or not os.path.isdir(path):
+            self._write_index(index)
+            return None
+
+        try:
+            # plain ndarray views of the maps, slicing np.memmap objects is much slower
+            arrays = {
+                array_name: np.asarray(np.load(os.path.join(path, array_name + '.npy'), mmap_mode='r'))
+                for array_name in entry['arrays']
+            }
+        except (IOError, ValueError):
+            return None
+
+        entry['last_used'] = time.time()
+        self._write_index(index)
+
+        return arrays
+
+    def store(self, filename, kind, arrays):
+        index = self._read_index()
+        name = self._entry_name(filename, kind, index)
+        path = os.path.join(self.directory, name)
+
+        # write next to the final place and swap it in, readers never see half an entry
+        tmp_path = '{}.{}.tmp'.format(path, os.getpid())
+        shutil.rmtree(tmp_path, ignore_errors=True)
+        os.makedirs(tmp_path)
+
+        size = 0
+        for array_name, array in arrays.items():
+            array_path = os.path.join(tmp_path, array_name + '.npy')
+            np.save(array_path, np.ascontiguousarray(array))
+            size += os.path.getsize(array_path)
+
+        shutil.rmtree(path, ignore_errors=True)
+        os.replace(tmp_path, path)
+
+        index['entries'][name] = {'arrays': sorted(arrays), 'bytes': size, 'last_used': time.time()}
+        self._evict(index, keep=name)
+        self._write_index(index)
+
+    def _evict(self, index, keep=None):
+        entries = index['entries']
+        total = sum(entry['bytes'] for entry in entries.values())
+
+        for name in sorted(entries, key=lambda name: entries[name]['last_used']):
+            if total <= self.max_bytes:
+                break
+            if name == keep:
+                continue
+
+            total -= entries[name]['bytes']
+            del entries[name]
+            shutil.rmtree(os.path.join(self.directory, name), ignore_errors=True)
+
+    def size(self):
+        return sum(entry['bytes'] for entry in self._read_index()['entries'].values())
+
+    def clear(self):
+        index = self._read_index()
+
+        for name in list(index['entries']):
+            shutil.rmtree(os.path.join(self.directory, name), ignore_errors=True)
+
+        index['entries'] = {}
+        self._write_index(index)
@@ -0,0 +1,71 @@
+import os
+import json
+import time
+
+import numpy as np
+
+
+class Checkpoint(object):
+    # a partly rendered frame on disk: the HDR pixels and the object ids seen through
+    # them in memory mapped .npy files and a JSON index of the tiles already in them, all
+    # named after the key of the render. The index is only written after the pixels are
+    # flushed, so it never lists a tile that isn't on disk; a killed render loses at most
+    # the last interval of work
+    INTERVAL = 1.0
+
+    def __init__(self, directory, key, width, height):
+        os.makedirs(directory, exist_ok=True)
+
+        self._pixels_path = os.path.join(directory, key + '.npy')
+        self._ids_path = os.path.join(directory, key + '.ids.npy')
+        self._index_path = os.path.join(directory, key + '.json')
+        self._saved = time.time()
+
+        self.done = set()
+        self.hdr = None
+        self.ids = None
+
+        if all(os.path.exists(path) for path in (self._pixels_path, self._ids_path, self._index_path)):
+            try:
+                hdr = np.lib.format.open_memmap(self._pixels_path, mode='r+')
+                ids = np.lib.format.open_memmap(self._ids_path, mode='r+')
+                with open(self._index_path) as f:
+                    done = set(json.load(f)['tiles'])
+
+                if (hdr.shape == (height, width, 3) and hdr.dtype == np.float32 and
+                        ids.shape == (height, width) and ids.dtype == np.int32):
+                    self.hdr, self.ids, self.done = hdr, ids, done
+            except (IOError, ValueError, KeyError):
+                pass
+
+        if self.hdr is None:
+            self.hdr = np.lib.format.open_memmap(self._pixels_path, mode='w+', dtype=np.float32,
+                                                 shape=(height, width, 3))
+            self.ids = np.lib.format.open_memmap(self._ids_path, mode='w+', dtype=np.int32,
+                                                 shape=(height, width))
+            self.save()
+
+    def mark(self, tile):
+        # tile (an index) is complete in hdr and ids
+        self.done.add(tile)
+
+        if time.time() - self._saved >= self.INTERVAL:
+            self.save()
+
+    def save(self):
+        self.hdr.flush()
+        self.ids.flush()
+
+        temporary = self._index_path + '.tmp'
+        with open(temporary, 'w') as f:
+            json.dump({'tiles': sorted(self.done)}, f)
+        os.replace(temporary, self._index_path)
+
+        self._saved = time.time()
+
+    def remove(self):
+        self.hdr = self.ids = None
+
+        for path in (self._index_path, self._pixels_path, self._ids_path):
+            if os.path.exists(path):
+                os.remove(path)
@@ -0,0 +1,452 @@
+import time
+import pickle
+import hashlib
+import socket
+import struct
+import argparse
+import threading
+import traceback
+
+from collections import Counter, deque
+
+import numpy as np
+
+from renderer import _init_worker, _render_worker_tile, _render_worker_pixels
+
+
+# messages are pickles behind their 8 byte length
+_HEADER = struct.Struct('!Q')
+
+# seconds between the messages of a busy worker telling the coordinator it is alive
+HEARTBEAT = 0.5
+
+
+def _no_delay(connection):
+    # a tile is a couple of small writes waiting on each other, Nagle would hold them back
+    connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+    return connection
+
+
+def _send(connection, message):
+    data = pickle.dumps(message, pickle.HIGHEST_PROTOCOL)
+
+    connection.sendall(_HEADER.pack(len(data)))
+    connection.sendall(data)
+
+
+def _read(connection, size):
+    data = bytearray(size)
+    view = memoryview(data)
+
+    while len(view):
+        count = connection.recv_into(view)
+        if not count:
+            raise EOFError('Connection closed')
+        view = view[count:]
+
+    return data
+
+
+def _receive(connection):
+    size, = _HEADER.unpack(_read(connection, _HEADER.size))
+
+    return pickle.loads(_read(connection, size))
+
+
+class _Job(object):
+    # work items of a frame, ('tile', tile) or ('pixels', (columns, rows)) messages for
+    # the workers, and who is rendering which. running maps an item index to [time it
+    # was first handed out, names of the workers rendering it]. collect(job, index,
+    # result) takes the results in
+    __slots__ = ('payload', 'digest', 'items', 'collect', 'pending', 'running', 'done', 'error',
+                 'elapsed', 'items_per_worker', 'requeued', 'backups', 'percent')
+
+    def __init__(self, payload, digest, items, collect):
+        self.payload = payload
+        self.digest = digest
+        self.items = items
+        self.collect = collect
+
+        self.pending = deque(range(len(items)))
+        self.running = {}
+        self.done = set()
+        self.error = None
+
+        # seconds spent on the finished items, from handing them out to their result
+        self.elapsed = 0.0
+        self.items_per_worker = Counter()
+        self.requeued = 0
+        self.backups = 0
+        self.percent = 0
+
+    def finished(self):
+        return self.error is not None or len(self.done) == len(self.items)
+
+
+class Coordinator(object):
+    # renders the frames of renderer on worker processes connecting over TCP, on this
+    # machine or on others with the same code:
+    #     python distributed.py HOST:PORT
+    # Workers may come and go at any time. For every render the scene is pickled once and
+    # sent to each worker that doesn't have that very scene (and renderer settings) from
+    # the render before, then tiles and anti aliasing samples are handed out one batch
+    # at a time. Busy workers send a heartbeat, the tiles of workers that disconnect or
+    # go silent for timeout seconds are queued again. A worker taking long on a tile is never dropped: once the queue
+    # is empty, tiles running slow_factor times longer than the average tile are handed
+    # to idle workers as well, the first result wins.
+    # Everything sent is a pickle, only connect hosts that trust each other
+    POLL = 0.05
+
+    def __init__(self, renderer, address=('127.0.0.1', 0), timeout=60.0, slow_factor=4.0):
+        if timeout <= 2 * HEARTBEAT:
+            raise ValueError('The timeout has to be longer than two heartbeats ({} sec.)'.format(2 * HEARTBEAT))
+
+        self.renderer = renderer
+        self.timeout = timeout
+        self.slow_factor = slow_factor
+
+        self._server = socket.create_server(address)
+        self._server.settimeout(self.POLL)
+        self.address = self._server.getsockname()[:2]
+
+        self._lock = threading.Condition()
+        self._job = None
+        self._connected = 0
+        self._closed = False
+
+        self.report = None
+
+        threading.Thread(target=self._accept, daemon=True).start()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        # connected workers are told to exit
+        with self._lock:
+            self._closed = True
+            self._lock.notify_all()
+
+    def _accept(self):
+        with self._server:
+            while not self._closed:
+                try:
+                    connection, _ = self._server.accept()
+                except socket.timeout:
+                    continue
+
+                threading.Thread(target=self._serve, args=(connection,), daemon=True).start()
+
+    def _serve(self, connection):
+        name = '%s:%d' % connection.getpeername()[:2]
+        job = digest = None
+
+        with self._lock:
+            self._connected += 1
+        try:
+            with _no_delay(connection):
+                # a worker saying nothing for this long is gone, busy ones send heartbeats
+                connection.settimeout(self.timeout)
+
+                while True:
+                    with self._lock:
+                        self._lock.wait_for(lambda: self._closed or self._job not in (None, job))
+                        if self._closed:
+                            break
+                        job = self._job
+
+                    if job.digest != digest:
+                        _send(connection, ('scene', job.payload))
+                        digest = job.digest
+
+                    self._work(connection, name, job)
+
+                _send(connection, None)
+        except (OSError, EOFError):
+            pass
+        finally:
+            with self._lock:
+                self._connected -= 1
+                self._lock.notify_all()
+
+    def _work(self, connection, name, job):
+        # renders items of job on the worker at connection until all of them are done
+        while True:
+            with self._lock:
+                index = None
+                while not job.finished():
+                    index = self._next_tile(job, name)
+                    if index is not None:
+                        break
+                    self._lock.wait(self.POLL)
+
+                if index is None:
+                    return
+
+            try:
+                _send(connection, job.items[index])
+
+                kind, result = _receive(connection)
+                while kind == 'alive':
+                    kind, result = _receive(connection)
+            except BaseException:
+                with self._lock:
+                    self._release(job, index, name)
+                raise
+
+            with self._lock:
+                if kind == 'error':
+                    job.error = 'Worker %s failed:\n%s' % (name, result)
+                else:
+                    self._complete(job, index, name, result)
+                self._lock.notify_all()
+
+    def _next_tile(self, job, name):
+        # a queued tile, or a backup of the slowest running one, or None
+        now = time.time()
+
+        if job.pending:
+            index = job.pending.popleft()
+        else:
+            if not job.done:
+                return None
+
+            average = job.elapsed / len(job.done)
+            slow = [(start, index) for index, (start, workers) in job.running.items()
+                    if len(workers) == 1 and name not in workers and now - start > self.slow_factor * average]
+            if not slow:
+                return None
+
+            _, index = min(slow)
+            job.backups += 1
+
+        job.running.setdefault(index, [now, set()])[1].add(name)
+
+        return index
+
+    def _release(self, job, index, name):
+        # the worker name won't finish tile index, queue it again if nobody else renders it
+        if index not in job.running:
+            return
+
+        workers = job.running[index][1]
+        workers.discard(name)
+        if not workers:
+            del job.running[index]
+            job.pending.appendleft(index)
+            job.requeued += 1
+
+        self._lock.notify_all()
+
+    def _complete(self, job, index, name, result):
+        if index in job.done:
+            # a backup that lost
+            return
+
+        start, _ = job.running.pop(index)
+        job.elapsed += time.time() - start
+        job.done.add(index)
+        job.items_per_worker[name] += 1
+
+        job.collect(job, index, result)
+
+    def _wait(self, job):
+        # raises when no worker is connected for timeout seconds
+        alone_since = time.time()
+
+        while not job.finished():
+            if self._connected:
+                alone_since = time.time()
+            elif time.time() - alone_since > self.timeout:
+                job.error = 'No render worker connected for %d sec.' % self.timeout
+                break
+
+            self._lock.wait(self.POLL)
+
+    def _run(self, job):
+        # hands the items of job out until all of them are collected
+        with self._lock:
+            self._job = job
+            self._lock.notify_all()
+            try:
+                self._wait(job)
+            finally:
+                if not job.finished():
+                    job.error = 'Render interrupted'
+                self._job = None
+
+        if len(job.done) != len(job.items):
+            raise RuntimeError(job.error)
+
+    def _render_tiles(self, payload, digest, frame):
+        renderer = self.renderer
+        tiles = renderer._tiles()
+
+        def collect(job, index, result):
+            (x0, y0, x1, y1), pixels = renderer._collect_tile(result)
+            frame.hdr[y0:y1, x0:x1] = pixels
+
+            job.percent = renderer._report_progress(len(job.done), len(tiles), job.percent)
+
+        job = _Job(payload, digest, [('tile', tile) for tile in tiles], collect)
+        self._run(job)
+
+        return job
+
+    def _antialias(self, payload, digest, frame):
+        # the edges are found here, their samples are rendered by the workers
+        renderer = self.renderer
+        pixels, (columns, rows) = renderer._antialias_samples(frame)
+        chunks = renderer._sample_chunks(len(columns))
+
+        colors = np.empty((len(columns), 3), dtype=np.float32)
+        cost = None if renderer.stats is None else np.zeros(len(columns))
+
+        def collect(job, index, result):
+            colors[chunks[index]], chunk_cost = renderer._collect_pixels(result)
+            if cost is not None:
+                cost[chunks[index]] = chunk_cost
+
+        job = _Job(payload, digest, [('pixels', (columns[chunk], rows[chunk])) for chunk in chunks], collect)
+        self._run(job)
+
+        renderer._refine(frame, pixels, colors, cost)
+
+        return job
+
+    def render(self, scene):
+        renderer = self.renderer
+        start = time.time()
+        frame = renderer._create_frame()
+
+        # the workers get the acceleration structures ready made
+        scene.prepare()
+        payload = pickle.dumps((renderer, scene), pickle.HIGHEST_PROTOCOL)
+        digest = hashlib.blake2b(payload, digest_size=16).digest()
+
+        renderer._begin()
+        try:
+            jobs = [self._render_tiles(payload, digest, frame)]
+
+            if renderer._options['aa_grid']:
+                jobs.append(self._antialias(payload, digest, frame))
+        finally:
+            renderer._finish(start)
+
+        items_per_worker = sum((job.items_per_worker for job in jobs), Counter())
+        self.report = {
+            'elapsed': time.time() - start,
+            'scene_bytes': len(payload),
+            'workers': len(items_per_worker),
+            'items_per_worker': dict(items_per_worker),
+            'requeued': sum(job.requeued for job in jobs),
+            'backups': sum(job.backups for job in jobs),
+        }
+        print('[DISTRIBUTED workers=%d scene=%.1f MB requeued=%d backups=%d] tiles and sample batches: %s' % (
+            self.report['workers'], len(payload) / 2 ** 20, self.report['requeued'], self.report['backups'],
+            ' '.join('%s=%d' % item for item in sorted(items_per_worker.items()))))
+
+        return frame
+
+
+def _connect(address, wait):
+    # the coordinator may not be listening yet
+    deadline = time.time() + wait
+
+    while True:
+        try:
+            return _no_delay(socket.create_connection(address))
+        except OSError:
+            if time.time() > deadline:
+                raise
+            time.sleep(0.1)
+
+
+class _Heartbeat(object):
+    # sends ('alive', None) every HEARTBEAT seconds while the worker is busy with a
+    # message. Replies go through reply, a heartbeat never cuts into one or follows it
+    def __init__(self, connection):
+        self._connection = connection
+        self._lock = threading.Lock()
+        self._busy = False
+        self._stopped = threading.Event()
+
+        threading.Thread(target=self._run, daemon=True).start()
+
+    def _run(self):
+        while not self._stopped.wait(HEARTBEAT):
+            with self._lock:
+                if not self._busy:
+                    continue
+
+                try:
+                    _send(self._connection, ('alive', None))
+                except OSError:
+                    return
+
+    def busy(self, busy=True):
+        with self._lock:
+            self._busy = busy
+
+    def reply(self, message):
+        with self._lock:
+            self._busy = False
+            _send(self._connection, message)
+
+    def stop(self):
+        self._stopped.set()
+
+
+def run_worker(address, wait=10.0):
+    # renders tiles and samples for the coordinator at address (host, port) until it lets go
+    with _connect(address, wait) as connection:
+        heartbeat = _Heartbeat(connection)
+        try:
+            while True:
+                try:
+                    message = _receive(connection)
+                except (OSError, EOFError):
+                    return
+
+                if message is None:
+                    return
+
+                kind, body = message
+                heartbeat.busy()
+                try:
+                    if kind == 'scene':
+                        _init_worker(*pickle.loads(body))
+                        heartbeat.busy(False)
+                        continue
+
+                    if kind == 'tile':
+                        reply = ('tile', _render_worker_tile(body))
+                    else:
+                        reply = ('pixels', _render_worker_pixels(*body))
+                except Exception:
+                    reply = ('error', traceback.format_exc())
+
+                try:
+                    heartbeat.reply(reply)
+                except OSError:
+                    return
+        finally:
+            heartbeat.stop()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Render worker of a distributed.Coordinator')
+    parser.add_argument('address', help='HOST:PORT the coordinator listens on')
+    parser.add_argument('--wait', type=float, default=10.0, help='seconds to keep trying to connect')
+    args = parser.parse_args(argv)
+
+    host, port = args.address.rsplit(':', 1)
+    run_worker((host, int(port)), args.wait)
+
+
+if __name__ == '__main__':
+    main()
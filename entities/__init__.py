@@ -1,4 +1,6 @@
 from .base import Vector2, Vector3, Vector4
-from .objects import Sphere, Panel, SceneIntersectionObject, Box
+from .objects import Sphere, Panel, SceneIntersectionObject, Box, MeshInstance, SphereSet
 from .materials import Material
-from .light import Light
\ No newline at end of file
+from .light import Light
+from .camera import Camera
+from .transform import Transform
@@ -3,7 +3,7 @@ import operator
 
 
 class Vector(object):
-    __slots__ = ('dimension', '_coordinates')
+    __slots__ = ()
 
     def __init__(self, coordinates):
         self._coordinates = coordinates
@@ -73,7 +73,7 @@ class Vector(object):
         return self.__process_vector_operation__(other, operator.sub)
 
     def __rsub__(self, other):
-        return self.__sub__(other)
+        return (-self).__add__(other)
 
     def __mul__(self, other):
         if isinstance(other, (int, float)):
@@ -88,7 +88,7 @@ class Vector(object):
 
 
 class Vector2(Vector):
-    __slots__ = Vector.__slots__
+    __slots__ = ('dimension', '_coordinates')
 
     def __init__(self, x=0, y=0):
         super(Vector2, self).__init__([x, y])
@@ -111,42 +111,124 @@ class Vector2(Vector):
 
 
 class Vector3(Vector):
-    __slots__ = Vector.__slots__
+    # immutable and specialized: this is the type of every point, direction and color
+    # on the scalar path, so each operation is spelled out instead of going through
+    # the generic Vector machinery
+    __slots__ = ('x', 'y', 'z')
+
+    dimension = 3
 
     def __init__(self, x=0, y=0, z=0):
-        super(Vector3, self).__init__((x, y, z))
+        _set_x(self, x)
+        _set_y(self, y)
+        _set_z(self, z)
 
-    @property
-    def x(self):
-        return self._coordinates[0]
+    def __setattr__(self, name, value):
+        raise AttributeError("Vector3 is immutable")
 
-    @property
-    def y(self):
-        return self._coordinates[1]
+    def __reduce__(self):
+        return Vector3, (self.x, self.y, self.z)
+
+    def __repr__(self):
+        return "<Vector3: {}>".format(self.coordinates)
 
     @property
-    def z(self):
-        return self._coordinates[2]
-    
-    def __sub__(self, other):
-        # if isinstance(other, Vector3):
-        return Vector3(self._coordinates[0] - other._coordinates[0], self._coordinates[1] - other._coordinates[1], self._coordinates[2] - other._coordinates[2])
-        # return super(Vector3, self).__sub__(other)
+    def coordinates(self):
+        return self.x, self.y, self.z
 
-    def __process_scalar_operation__(self, other, operation):
-        return self._coordinates[0] * other._coordinates[0] + self._coordinates[1] * other._coordinates[1] + self._coordinates[2] * other._coordinates[2]
+    def __iter__(self):
+        return iter((self.x, self.y, self.z))
 
     def __getitem__(self, index):
-        return self._coordinates[index]
+        return (self.x, self.y, self.z)[index]
 
     def __setitem__(self, index, value):
-        if not isinstance(self._coordinates, list):
-            self._coordinates = list(self._coordinates)
-        self._coordinates[index] = value
+        raise TypeError("Vector3 is immutable")
+
+    def __eq__(self, other):
+        if not isinstance(other, Vector3):
+            return NotImplemented
+        return self.x == other.x and self.y == other.y and self.z == other.z
+
+    def __hash__(self):
+        return hash((self.x, self.y, self.z))
+
+    def __add__(self, other):
+        if type(other) is Vector3:
+            return Vector3(self.x + other.x, self.y + other.y, self.z + other.z)
+        if isinstance(other, (int, float)):
+            return Vector3(self.x + other, self.y + other, self.z + other)
+        return NotImplemented
+
+    def __radd__(self, other):
+        return self.__add__(other)
+
+    def __sub__(self, other):
+        if type(other) is Vector3:
+            return Vector3(self.x - other.x, self.y - other.y, self.z - other.z)
+        if isinstance(other, (int, float)):
+            return Vector3(self.x - other, self.y - other, self.z - other)
+        return NotImplemented
+
+    def __rsub__(self, other):
+        if isinstance(other, (int, float)):
+            return Vector3(other - self.x, other - self.y, other - self.z)
+        return NotImplemented
+
+    def __mul__(self, other):
+        # vector * vector is the dot product, vector * number scales
+        if type(other) is Vector3:
+            return self.x * other.x + self.y * other.y + self.z * other.z
+        return Vector3(self.x * other, self.y * other, self.z * other)
+
+    def __rmul__(self, other):
+        return Vector3(self.x * other, self.y * other, self.z * other)
+
+    def __truediv__(self, other):
+        return Vector3(self.x / other, self.y / other, self.z / other)
+
+    def __neg__(self):
+        return Vector3(-self.x, -self.y, -self.z)
+
+    def dot(self, other):
+        return self.x * other.x + self.y * other.y + self.z * other.z
+
+    def cross(self, other):
+        return Vector3(self.y * other.z - self.z * other.y,
+                       self.z * other.x - self.x * other.z,
+                       self.x * other.y - self.y * other.x)
+
+    def norm(self):
+        return math.sqrt(self.x * self.x + self.y * self.y + self.z * self.z)
+
+    def normalized(self):
+        norm = math.sqrt(self.x * self.x + self.y * self.y + self.z * self.z)
+
+        if norm == 0:
+            return self
+
+        return Vector3(self.x / norm, self.y / norm, self.z / norm)
+
+    # Vector3 is immutable, normalize returns the normalized copy like normalized does
+    normalize = normalized
+
+    def madd(self, other, scale):
+        # self + other * scale without the intermediate vector
+        return Vector3(self.x + other.x * scale, self.y + other.y * scale, self.z + other.z * scale)
+
+    def reflect(self, normal):
+        scale = 2 * (self.x * normal.x + self.y * normal.y + self.z * normal.z)
+        return Vector3(self.x - normal.x * scale, self.y - normal.y * scale, self.z - normal.z * scale)
+
+
+# slot setters, Vector3.__setattr__ refuses assignments once the vector is built
+_set_x = Vector3.x.__set__
+_set_y = Vector3.y.__set__
+_set_z = Vector3.z.__set__
 
 
 class Vector4(Vector):
-    __slots__ = Vector.__slots__
+    __slots__ = ('dimension', '_coordinates')
 
     def __init__(self, x=0, y=0, z=0, alfa=0):
         super(Vector4, self).__init__([x, y, z, alfa])
@@ -0,0 +1,415 @@
+import time
+
+import numpy as np
+
+
+class BVH(object):
+    # bounding volume hierarchy over arbitrary primitives given by their bounds,
+    # built with binned SAH. Nodes are stored flat: a node is a leaf when its
+    # count is non zero, then start/count address a range of self.indices
+    def __init__(self, lower, upper, leaf_size=4, bins=16):
+        start = time.time()
+
+        self.leaf_size = leaf_size
+        self.bins = bins
+
+        lower = np.asarray(lower, dtype=float).reshape(-1, 3)
+        upper = np.asarray(upper, dtype=float).reshape(-1, 3)
+
+        if not len(lower):
+            raise ValueError("BVH needs at least one primitive")
+
+        self._build(lower, upper)
+
+        self.build_time = time.time() - start
+
+    _ARRAYS = ('indices', 'node_lower', 'node_upper', 'node_left', 'node_right', 'node_axis', 'node_start', 'node_count')
+
+    def to_arrays(self, prefix=''):
+        # flat arrays describing the whole tree, enough to rebuild it with from_arrays
+        arrays = {prefix + name: getattr(self, name) for name in self._ARRAYS}
+        arrays[prefix + 'params'] = np.array([self.leaf_size, self.bins, self.depth], dtype=np.int64)
+
+        return arrays
+
+    @classmethod
+    def from_arrays(cls, arrays, prefix=''):
+        start = time.time()
+
+        bvh = cls.__new__(cls)
+        bvh.leaf_size, bvh.bins, bvh.depth = (int(value) for value in arrays[prefix + 'params'])
+
+        for name in cls._ARRAYS:
+            setattr(bvh, name, arrays[prefix + name])
+
+        bvh._prepare_scalar_nodes()
+        bvh.build_time = time.time() - start
+
+        return bvh
+
+    @classmethod
+    def _area(cls, lower, upper):
+        extent = np.maximum(upper - lower, 0)
+        return 2 * (extent[..., 0] * extent[..., 1] + extent[..., 1] * extent[..., 2] + extent[..., 2] * extent[..., 0])
+
+    def _find_split(self, lower, upper, centroids, node_area):
+        # returns (cost, axis, mask of the left side) or None, all three axes are binned at once
+        count = len(centroids)
+        bins = self.bins
+
+        c_min = centroids.min(axis=0)
+        extent = centroids.max(axis=0) - c_min
+
+        bin_ids = ((centroids - c_min) / np.where(extent > 0, extent, 1) * bins).astype(np.int64)
+        bin_ids = np.minimum(bin_ids, bins - 1)
+
+        keys = (bin_ids + np.arange(3) * bins).ravel()
+        counts = np.bincount(keys, minlength=3 * bins).reshape(3, bins)
+
+        bin_lower = np.full((3 * bins, 3), np.inf)
+        bin_upper = np.full((3 * bins, 3), -np.inf)
+        np.minimum.at(bin_lower, keys, np.repeat(lower, 3, axis=0))
+        np.maximum.at(bin_upper, keys, np.repeat(upper, 3, axis=0))
+        bin_lower = bin_lower.reshape(3, bins, 3)
+        bin_upper = bin_upper.reshape(3, bins, 3)
+
+        # sweep the bins from both sides to get area and count of every split
+        left_lower = np.minimum.accumulate(bin_lower, axis=1)[:, :-1]
+        left_upper = np.maximum.accumulate(bin_upper, axis=1)[:, :-1]
+        right_lower = np.minimum.accumulate(bin_lower[:, ::-1], axis=1)[:, ::-1][:, 1:]
+        right_upper = np.maximum.accumulate(bin_upper[:, ::-1], axis=1)[:, ::-1][:, 1:]
+
+        left_count = np.cumsum(counts, axis=1)[:, :-1]
+        right_count = count - left_count
+
+        with np.errstate(invalid='ignore'):
+            cost = (self._area(left_lower, left_upper) * left_count +
+                    self._area(right_lower, right_upper) * right_count) / node_area
+        cost[(left_count == 0) | (right_count == 0)] = np.inf
+
+        axis, split = np.unravel_index(np.argmin(cost), cost.shape)
+        if not np.isfinite(cost[axis, split]):
+            return None
+
+        return cost[axis, split], int(axis), bin_ids[:, axis] <= split
+
+    @classmethod
+    def _median_split(cls, centroids):
+        axis = int(np.argmax(np.ptp(centroids, axis=0)))
+
+        mask = np.zeros(len(centroids), dtype=bool)
+        mask[np.argsort(centroids[:, axis], kind='stable')[:len(centroids) // 2]] = True
+
+        return None, axis, mask
+
+    def _build(self, lower, upper):
+        centroids = (lower + upper) * 0.5
+
+        node_lower, node_upper = [], []
+        node_left, node_right, node_axis = [], [], []
+        node_start, node_count = [], []
+        indices = []
+
+        def new_node():
+            for items in (node_lower, node_upper, node_left, node_right, node_axis, node_start, node_count):
+                items.append(0)
+            return len(node_lower) - 1
+
+        root = new_node()
+        stack = [(root, np.arange(len(lower)), 0)]
+        self.depth = 0
+
+        while stack:
+            node, primitives, depth = stack.pop()
+            self.depth = max(self.depth, depth)
+
+            bounds_lower = lower[primitives].min(axis=0)
+            bounds_upper = upper[primitives].max(axis=0)
+            node_lower[node] = bounds_lower
+            node_upper[node] = bounds_upper
+
+            split = None
+            if len(primitives) > 2 * self.bins:
+                node_area = max(self._area(bounds_lower, bounds_upper), 1e-12)
+                split = self._find_split(lower[primitives], upper[primitives], centroids[primitives], node_area)
+
+                # traversal is about as expensive as one primitive test
+                if split is not None and split[0] + 1 >= len(primitives):
+                    split = None
+
+            if split is None and len(primitives) > self.leaf_size:
+                # small nodes (or nodes SAH could not split) are split at the median,
+                # binning them costs more than it saves
+                split = self._median_split(centroids[primitives])
+
+            if split is None:
+                node_start[node] = len(indices)
+                node_count[node] = len(primitives)
+                indices.extend(primitives.tolist())
+                continue
+
+            _, axis, mask = split
+            left, right = new_node(), new_node()
+            node_left[node], node_right[node], node_axis[node] = left, right, axis
+
+            stack.append((right, primitives[~mask], depth + 1))
+            stack.append((left, primitives[mask], depth + 1))
+
+        self.indices = np.array(indices, dtype=np.int64)
+        self.node_lower = np.array(node_lower, dtype=float).reshape(-1, 3)
+        self.node_upper = np.array(node_upper, dtype=float).reshape(-1, 3)
+        self.node_left = np.array(node_left, dtype=np.int64)
+        self.node_right = np.array(node_right, dtype=np.int64)
+        self.node_axis = np.array(node_axis, dtype=np.int64)
+        self.node_start = np.array(node_start, dtype=np.int64)
+        self.node_count = np.array(node_count, dtype=np.int64)
+
+        self._prepare_scalar_nodes()
+
+    def refit(self, lower, upper):
+        # new bounds for the same primitives: node bounds are recomputed bottom up and the
+        # tree itself is kept. Much cheaper than a build, but the tree gets worse the
+        # farther the primitives move from where they were when it was built
+        lower = np.asarray(lower, dtype=float).reshape(-1, 3)
+        upper = np.asarray(upper, dtype=float).reshape(-1, 3)
+
+        # arrays loaded from the asset cache are read only
+        self.node_lower = np.array(self.node_lower)
+        self.node_upper = np.array(self.node_upper)
+
+        # leaves cover self.indices in consecutive ranges
+        leaves = np.nonzero(self.node_count)[0]
+        leaves = leaves[np.argsort(self.node_start[leaves])]
+        starts = self.node_start[leaves]
+
+        self.node_lower[leaves] = np.minimum.reduceat(lower[self.indices], starts)
+        self.node_upper[leaves] = np.maximum.reduceat(upper[self.indices], starts)
+
+        # children are always stored after their parent
+        for node in np.nonzero(self.node_count == 0)[0][::-1].tolist():
+            left, right = self.node_left[node], self.node_right[node]
+            self.node_lower[node] = np.minimum(self.node_lower[left], self.node_lower[right])
+            self.node_upper[node] = np.maximum(self.node_upper[left], self.node_upper[right])
+
+        self._prepare_scalar_nodes()
+
+    def _prepare_scalar_nodes(self):
+        # plain python tuples are much faster than numpy scalars for the single ray traversal
+        self._nodes = list(zip(
+            *self.node_lower.T.tolist(), *self.node_upper.T.tolist(),
+            self.node_left.tolist(), self.node_right.tolist(),
+            self.node_start.tolist(), self.node_count.tolist(),
+        ))
+        self._indices = self.indices.tolist()
+
+    def stats(self):
+        leaves = self.node_count[self.node_count > 0]
+
+        return {
+            'primitives': len(self.indices),
+            'nodes': len(self.node_count),
+            'leaves': len(leaves),
+            'depth': self.depth,
+            'max_leaf_size': int(leaves.max()) if len(leaves) else 0,
+            'avg_leaf_size': float(leaves.mean()) if len(leaves) else 0.0,
+            'build_time': self.build_time,
+        }
+
+    def __repr__(self):
+        return '<BVH: {}>'.format(', '.join('{}={}'.format(k, round(v, 4)) for k, v in self.stats().items()))
+
+    @classmethod
+    def _slab(cls, node, ox, oy, oz, ix, iy, iz, t_max):
+        t1 = (node[0] - ox) * ix
+        t2 = (node[3] - ox) * ix
+        tmin, tmax = (t1, t2) if t1 < t2 else (t2, t1)
+
+        t1 = (node[1] - oy) * iy
+        t2 = (node[4] - oy) * iy
+        if t1 > t2:
+            t1, t2 = t2, t1
+        tmin = t1 if t1 > tmin else tmin
+        tmax = t2 if t2 < tmax else tmax
+
+        t1 = (node[2] - oz) * iz
+        t2 = (node[5] - oz) * iz
+        if t1 > t2:
+            t1, t2 = t2, t1
+        tmin = t1 if t1 > tmin else tmin
+        tmax = t2 if t2 < tmax else tmax
+
+        if tmax < 0 or tmin > tmax or tmin > t_max:
+            return None
+
+        return tmin
+
+    def intersect(self, origin, direction, leaf_intersect, t_max=float('inf')):
+        # front-to-back closest hit; leaf_intersect(primitives, t_max) returns
+        # (distance, result) of the nearest primitive closer than t_max or None
+        ox, oy, oz = origin[0], origin[1], origin[2]
+        ix = 1.0 / direction[0] if direction[0] else 1e30
+        iy = 1.0 / direction[1] if direction[1] else 1e30
+        iz = 1.0 / direction[2] if direction[2] else 1e30
+
+        nodes = self._nodes
+        indices = self._indices
+        result = None
+
+        if self._slab(nodes[0], ox, oy, oz, ix, iy, iz, t_max) is None:
+            return None
+
+        stack = [0]
+        while stack:
+            node = nodes[stack.pop()]
+
+            count = node[9]
+            if count:
+                start = node[8]
+                hit = leaf_intersect(indices[start: start + count], t_max)
+
+                if hit is not None:
+                    t_max, result = hit
+                continue
+
+            left, right = node[6], node[7]
+            t_left = self._slab(nodes[left], ox, oy, oz, ix, iy, iz, t_max)
+            t_right = self._slab(nodes[right], ox, oy, oz, ix, iy, iz, t_max)
+
+            if t_left is not None and t_right is not None:
+                # visit the nearest child first
+                if t_left <= t_right:
+                    stack.append(right)
+                    stack.append(left)
+                else:
+                    stack.append(left)
+                    stack.append(right)
+            elif t_left is not None:
+                stack.append(left)
+            elif t_right is not None:
+                stack.append(right)
+
+        return result
+
+    def occluded(self, origin, direction, leaf_occluded, t_max):
+        # any-hit query, stops at the first leaf where leaf_occluded(primitives, t_max) is true
+        ox, oy, oz = origin[0], origin[1], origin[2]
+        ix = 1.0 / direction[0] if direction[0] else 1e30
+        iy = 1.0 / direction[1] if direction[1] else 1e30
+        iz = 1.0 / direction[2] if direction[2] else 1e30
+
+        nodes = self._nodes
+        indices = self._indices
+
+        stack = [0]
+        while stack:
+            node = nodes[stack.pop()]
+
+            if self._slab(node, ox, oy, oz, ix, iy, iz, t_max) is None:
+                continue
+
+            count = node[9]
+            if count:
+                start = node[8]
+
+                if leaf_occluded(indices[start: start + count], t_max):
+                    return True
+                continue
+
+            stack.append(node[7])
+            stack.append(node[6])
+
+        return False
+
+    def _slab_packet(self, node, origins, inverse, t_max):
+        t1 = (self.node_lower[node] - origins) * inverse
+        t2 = (self.node_upper[node] - origins) * inverse
+
+        tmin = np.minimum(t1, t2).max(axis=1)
+        tmax = np.maximum(t1, t2).min(axis=1)
+
+        return (tmax >= 0) & (tmin <= tmax) & (tmin <= t_max)
+
+    def intersect_packet(self, origins, directions, leaf_intersect, t_max=None):
+        # closest hit for a batch of rays; leaf_intersect(primitives, origins, directions, t_max)
+        # returns (distances, primitives) arrays with np.inf where the ray has no hit closer
+        # than t_max, primitives may carry extra columns (the scene stores object and
+        # primitive index there). Rays without a hit come back with np.inf
+        count = len(origins)
+        distances = np.full(count, np.inf)
+        if t_max is not None:
+            distances[:] = t_max
+        primitives = None
+        hit = np.zeros(count, dtype=bool)
+
+        with np.errstate(divide='ignore'):
+            inverse = np.where(directions != 0, 1.0 / np.where(directions != 0, directions, 1), 1e30)
+
+        stack = [(0, np.arange(count))]
+        while stack:
+            node, rays = stack.pop()
+
+            rays = rays[self._slab_packet(node, origins[rays], inverse[rays], distances[rays])]
+            if not len(rays):
+                continue
+
+            leaf_count = self.node_count[node]
+            if leaf_count:
+                start = self.node_start[node]
+                leaf_distances, leaf_primitives = leaf_intersect(
+                    self.indices[start: start + leaf_count], origins[rays], directions[rays], distances[rays])
+
+                if primitives is None:
+                    primitives = np.full((count,) + leaf_primitives.shape[1:], -1, dtype=np.int64)
+
+                closer = leaf_distances < distances[rays]
+                distances[rays[closer]] = leaf_distances[closer]
+                primitives[rays[closer]] = leaf_primitives[closer]
+                hit[rays[closer]] = True
+                continue
+
+            # the child on the side the rays are travelling from goes first
+            left, right = self.node_left[node], self.node_right[node]
+            if directions[rays, self.node_axis[node]].sum() < 0:
+                left, right = right, left
+
+            stack.append((right, rays))
+            stack.append((left, rays))
+
+        if primitives is None:
+            primitives = np.full(count, -1, dtype=np.int64)
+
+        distances[~hit] = np.inf
+
+        return distances, primitives
+
+    def occluded_packet(self, origins, directions, leaf_occluded, t_max):
+        # any-hit query for a batch of rays; leaf_occluded(primitives, origins, directions, t_max)
+        # returns a mask of the rays blocked within t_max, blocked rays leave the traversal
+        count = len(origins)
+        t_max = np.broadcast_to(np.asarray(t_max, dtype=float), (count,))
+        occluded = np.zeros(count, dtype=bool)
+
+        with np.errstate(divide='ignore'):
+            inverse = np.where(directions != 0, 1.0 / np.where(directions != 0, directions, 1), 1e30)
+
+        stack = [(0, np.arange(count))]
+        while stack:
+            node, rays = stack.pop()
+
+            rays = rays[~occluded[rays]]
+            rays = rays[self._slab_packet(node, origins[rays], inverse[rays], t_max[rays])]
+            if not len(rays):
+                continue
+
+            leaf_count = self.node_count[node]
+            if leaf_count:
+                start = self.node_start[node]
+                blocked = leaf_occluded(self.indices[start: start + leaf_count],
+                                        origins[rays], directions[rays], t_max[rays])
+                occluded[rays[blocked]] = True
+                continue
+
+            stack.append((self.node_right[node], rays))
+            stack.append((self.node_left[node], rays))
+
+        return occluded
@@ -0,0 +1,41 @@
+import numpy as np
+
+import utils
+
+from .base import Vector3
+
+
+class Camera(object):
+    # primary rays leave position through an image plane one unit along forward,
+    # spanned by right and up. The default looks down -z with y up
+    __slots__ = ('position', 'forward', 'right', 'up')
+
+    def __init__(self, position=None, forward=None, up=None):
+        forward = (forward or Vector3(0, 0, -1)).normalize()
+        right = forward.cross(up or Vector3(0, 1, 0)).normalize()
+
+        self.position = position or Vector3(0, 0, 0)
+        self.forward = forward
+        self.right = right
+        self.up = right.cross(forward)
+
+    @classmethod
+    def look_at(cls, position, target, up=None):
+        return cls(position, target - position, up)
+
+    def key(self):
+        return tuple(self.position.coordinates), tuple(self.forward.coordinates), tuple(self.up.coordinates)
+
+    def direction(self, x, y):
+        # direction through the image plane point (x, y)
+        return (self.right * x + self.up * y + self.forward).normalize()
+
+    def directions(self, x, y):
+        # same for arrays of image plane coordinates, returns (n, 3) directions
+        x = np.asarray(x, dtype=float)[:, None]
+        y = np.asarray(y, dtype=float)[:, None]
+
+        directions = (x * np.array(self.right.coordinates) + y * np.array(self.up.coordinates)
+                      + np.array(self.forward.coordinates))
+
+        return utils.normalize_packet(directions)
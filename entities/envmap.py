@@ -0,0 +1,135 @@
+import math
+import hashlib
+
+import numpy as np
+
+from .base import Vector3
+
+
+class EnvironmentMap(object):
+    # equirectangular environment map decoded once into an array. Texels stay uint8
+    # (a float copy of a 7616x3808 map would take 350MB) and are scaled to [0, 1]
+    # when they are looked up. x wraps around the horizon, y is clamped at the poles
+    def __init__(self, image, filtering='nearest'):
+        if filtering not in ('nearest', 'bilinear'):
+            raise ValueError("Unknown filtering: {}".format(filtering))
+
+        if isinstance(image, np.ndarray):
+            pixels = image
+        else:
+            pixels = np.asarray(image.convert('RGB'))
+
+        self._pixels = np.ascontiguousarray(pixels, dtype=np.uint8)
+        self.height, self.width = self._pixels.shape[:2]
+        self.filtering = filtering
+
+        self._texels = None
+        self._key = None
+
+    @classmethod
+    def open(cls, filename, filtering='nearest', cache=None):
+        # with an AssetCache the decoded texels are stored once and memory mapped afterwards
+        if cache is not None:
+            arrays = cache.load(filename, 'envmap')
+            if arrays is not None:
+                return cls(arrays['pixels'], filtering)
+
+        from PIL import Image
+
+        with Image.open(filename) as image:
+            envmap = cls(image, filtering)
+
+        if cache is not None:
+            cache.store(filename, 'envmap', {'pixels': envmap.pixels})
+
+        return envmap
+
+    @property
+    def pixels(self):
+        return self._pixels
+
+    def __getstate__(self):
+        # the memoryview can't be pickled, workers build their own
+        return self._pixels, self.filtering
+
+    def __setstate__(self, state):
+        self._pixels, self.filtering = state
+        self.height, self.width = self._pixels.shape[:2]
+        self._texels = None
+        self._key = None
+
+    def key(self):
+        # hash of the texels, the same for every load of the same image
+        if self._key is None:
+            self._key = hashlib.blake2b(self._pixels.tobytes(), digest_size=16).hexdigest(), self.filtering
+
+        return self._key
+
+    def _texel(self, x, y):
+        # indexing a flat memoryview gives plain ints, much cheaper than numpy scalars
+        if self._texels is None:
+            self._texels = memoryview(self._pixels.reshape(-1))
+
+        offset = (y * self.width + x) * 3
+        texels = self._texels
+
+        return texels[offset], texels[offset + 1], texels[offset + 2]
+
+    def sample(self, direction):
+        direction = direction.normalize()
+
+        u = (math.atan2(direction.z, direction.x) / (2 * math.pi) + 0.5) * self.width
+        v = math.acos(max(-1.0, min(1.0, direction.y))) / math.pi * self.height
+
+        if self.filtering == 'nearest':
+            r, g, b = self._texel(int(u) % self.width, min(int(v), self.height - 1))
+            return Vector3(r / 255, g / 255, b / 255)
+
+        # bilinear: texel centers sit at half-integer coordinates
+        u -= 0.5
+        v -= 0.5
+        x0, y0 = math.floor(u), math.floor(v)
+        fx, fy = u - x0, v - y0
+
+        x1 = (x0 + 1) % self.width
+        x0 = x0 % self.width
+        y1 = min(max(y0 + 1, 0), self.height - 1)
+        y0 = min(max(y0, 0), self.height - 1)
+
+        color = [0.0, 0.0, 0.0]
+        for x, y, weight in ((x0, y0, (1 - fx) * (1 - fy)), (x1, y0, fx * (1 - fy)),
+                             (x0, y1, (1 - fx) * fy), (x1, y1, fx * fy)):
+            for channel, value in enumerate(self._texel(x, y)):
+                color[channel] += value * weight
+
+        return Vector3(color[0] / 255, color[1] / 255, color[2] / 255)
+
+    def sample_packet(self, directions):
+        norm = np.sqrt((directions * directions).sum(axis=1))
+        norm[norm == 0] = 1
+
+        u = (np.arctan2(directions[:, 2] / norm, directions[:, 0] / norm) / (2 * math.pi) + 0.5) * self.width
+        v = np.arccos(np.clip(directions[:, 1] / norm, -1, 1)) / math.pi * self.height
+
+        if self.filtering == 'nearest':
+            x = u.astype(np.int64) % self.width
+            y = np.minimum(v.astype(np.int64), self.height - 1)
+            return self._pixels[y, x] / 255
+
+        u -= 0.5
+        v -= 0.5
+        x0 = np.floor(u).astype(np.int64)
+        y0 = np.floor(v).astype(np.int64)
+        fx = (u - x0)[:, None]
+        fy = (v - y0)[:, None]
+
+        x1 = (x0 + 1) % self.width
+        x0 = x0 % self.width
+        y1 = np.clip(y0 + 1, 0, self.height - 1)
+        y0 = np.clip(y0, 0, self.height - 1)
+
+        pixels = self._pixels
+        color = (pixels[y0, x0] * ((1 - fx) * (1 - fy)) + pixels[y0, x1] * (fx * (1 - fy)) +
+                 pixels[y1, x0] * ((1 - fx) * fy) + pixels[y1, x1] * (fx * fy))
+
+        return color / 255
@@ -1,3 +1,5 @@
+import numpy as np
+
 from .base import Vector3, Vector4
 
 
@@ -10,3 +12,44 @@ class Material(object):
         self.specular_exponent = specular_exponent
         self.refractive_index = refractive_index
 
+    def key(self):
+        return (tuple(self.diffuse_color.coordinates), tuple(self.albedo.coordinates),
+                self.specular_exponent, self.refractive_index)
+
+    def packet(self, count):
+        return MaterialPacket(
+            np.tile(np.array(self.diffuse_color.coordinates, dtype=float), (count, 1)),
+            np.tile(np.array(self.albedo.coordinates, dtype=float), (count, 1)),
+            np.full(count, self.specular_exponent, dtype=float),
+            np.full(count, self.refractive_index, dtype=float),
+        )
+
+
+class MaterialPacket(object):
+    # structure-of-arrays view of the materials of a batch of hits
+    __slots__ = ('diffuse_color', 'albedo', 'specular_exponent', 'refractive_index')
+
+    def __init__(self, diffuse_color, albedo, specular_exponent, refractive_index):
+        self.diffuse_color = diffuse_color
+        self.albedo = albedo
+        self.specular_exponent = specular_exponent
+        self.refractive_index = refractive_index
+
+    @classmethod
+    def empty(cls, count):
+        return cls(np.zeros((count, 3)), np.zeros((count, 4)), np.zeros(count), np.ones(count))
+
+    @classmethod
+    def where(cls, mask, first, second):
+        return cls(
+            np.where(mask[:, None], first.diffuse_color, second.diffuse_color),
+            np.where(mask[:, None], first.albedo, second.albedo),
+            np.where(mask, first.specular_exponent, second.specular_exponent),
+            np.where(mask, first.refractive_index, second.refractive_index),
+        )
+
+    def assign(self, indices, other):
+        self.diffuse_color[indices] = other.diffuse_color
+        self.albedo[indices] = other.albedo
+        self.specular_exponent[indices] = other.specular_exponent
+        self.refractive_index[indices] = other.refractive_index
@@ -1,44 +1,144 @@
+import hashlib
+
+import numpy as np
+
+import stats
 import utils
 
 from .base import Vector3
+from .bvh import BVH
 
 
 class Model(object):
-    def __init__(self, filename):
+    # the mesh is kept as flat vertex / face index arrays, which is also what the asset
+    # cache stores; the Vector3 lists the scalar path walks are built on first use.
+    # Triangles are precomputed as a structure of arrays: one contiguous row per
+    # component of v0, edge_1 and edge_2, plus the unit normals
+
+    # blocks of at least this many triangles are tested with the vectorized kernel,
+    # below that the fixed cost of the numpy calls is higher than a plain loop
+    VECTOR_BLOCK = 256
+
+    def __init__(self, filename, leaf_size=4, cache=None):
+        self._leaf_size = leaf_size
+        self._bvh = None
+        self._scalar = None
+        self._triangle_rows = None
+        self._key = None
+
+        kind = 'model-leaf{}'.format(leaf_size)
+        arrays = cache.load(filename, kind) if cache is not None else None
+
+        if arrays is not None:
+            self._vertices, self._face_indices = arrays['vertices'], arrays['faces']
+            self._bvh = BVH.from_arrays(arrays, prefix='bvh_')
+            self._prepare_triangles()
+        else:
+            self._vertices, self._face_indices = self._parse(filename)
+            self._prepare_triangles()
+
+            if cache is not None:
+                arrays = self.bvh.to_arrays(prefix='bvh_')
+                arrays.update(vertices=self._vertices, faces=self._face_indices)
+                cache.store(filename, kind, arrays)
+
+    def key(self):
+        # hash of the mesh, the same for every load of the same geometry
+        if self._key is None:
+            digest = hashlib.blake2b(digest_size=16)
+            digest.update(np.ascontiguousarray(self._vertices).tobytes())
+            digest.update(np.ascontiguousarray(self._face_indices).tobytes())
+            self._key = digest.hexdigest()
+
+        return self._key
+
+    @classmethod
+    def _parse(cls, filename):
         vertex = []
         faces = []
-        triangles = []
         with open(filename, 'r') as f:
             for line in f:
-                line = line.strip()
+                items = line.split()
 
-                if not line:
+                if not items:
                     continue
 
-                items = line.split()
-
-                x, y, z = items[1:4]
-                if items[0] == 'v':                    
-                    vertex.append(Vector3(float(x), float(y), float(z)))
+                if items[0] == 'v':
+                    x, y, z = items[1:4]
+                    vertex.append((float(x), float(y), float(z)))
                 elif items[0] == 'f':
-                    faces.append(Vector3(int(x) - 1, int(y) - 1, int(z) - 1))
-                    triangles.append(
-                        (vertex[int(x) - 1], vertex[int(y) - 1], vertex[int(z) - 1])
-                    )
+                    # "f v/vt/vn ..." with optional negative indices, polygons are split into a fan
+                    indices = [int(item.split('/')[0]) for item in items[1:]]
+                    indices = [i - 1 if i > 0 else len(vertex) + i for i in indices]
+
+                    for k in range(1, len(indices) - 1):
+                        faces.append((indices[0], indices[k], indices[k + 1]))
+
+        return np.array(vertex, dtype=float).reshape(-1, 3), np.array(faces, dtype=np.int64).reshape(-1, 3)
+
+    def _get_scalar(self):
+        if self._scalar is None:
+            vertex = [Vector3(x, y, z) for x, y, z in self._vertices.tolist()]
+            faces = [Vector3(x, y, z) for x, y, z in self._face_indices.tolist()]
+            triangles = [(vertex[x], vertex[y], vertex[z]) for x, y, z in self._face_indices.tolist()]
+
+            self._scalar = vertex, faces, triangles
+
+        return self._scalar
+
+    def _prepare_triangles(self):
+        corners = np.asarray(self._vertices)[self._face_indices]
+
+        v0 = corners[:, 0]
+        edge_1 = corners[:, 1] - v0
+        edge_2 = corners[:, 2] - v0
+
+        # (9, triangles): v0x, v0y, v0z, e1x, e1y, e1z, e2x, e2y, e2z
+        self._triangle_soa = np.ascontiguousarray(np.hstack((v0, edge_1, edge_2)).T)
+        self._normals = utils.normalize_packet(utils.cross_packet(edge_1, edge_2))
+
+    def _get_triangle_rows(self):
+        # the same data as plain floats for the single ray path, one 9-tuple per
+        # triangle, and the normals as Vector3
+        if self._triangle_rows is None:
+            rows = list(zip(*self._triangle_soa.tolist()))
+            normals = [Vector3(x, y, z) for x, y, z in self._normals.tolist()]
 
-        self._vertex = vertex
-        self._faces = faces
-        self._triangles = triangles
+            self._triangle_rows = rows, normals
+
+        return self._triangle_rows
+
+    @property
+    def _vertex(self):
+        return self._get_scalar()[0]
+
+    @property
+    def _faces(self):
+        return self._get_scalar()[1]
+
+    @property
+    def _triangles(self):
+        return self._get_scalar()[2]
+
+    @property
+    def bvh(self):
+        if self._bvh is None:
+            v0, edge_1, edge_2, _ = self._get_triangle_arrays()
+            corners = np.stack((v0, v0 + edge_1, v0 + edge_2))
+
+            self._bvh = BVH(corners.min(axis=0), corners.max(axis=0), leaf_size=self._leaf_size)
+
+        return self._bvh
 
     @classmethod
     def _cross(cls, v1, v2):
         return utils.cross(v1, v2)
 
     def vertices_count(self):
-        return len(self._vertex)
+        return len(self._vertices)
 
     def triangles_count(self):
-        return len(self._faces)
+        return len(self._face_indices)
 
     def point_at(self, index):
         return self._vertex[index]
@@ -47,26 +147,151 @@ class Model(object):
         return self._faces[triangle_index][local_index]
 
     def get_bbox(self):
-        min_ = [self._vertex[0][0], self._vertex[0][1], self._vertex[0][2]]
-        max_ = min_[:]
+        return Vector3(*self._vertices.min(axis=0).tolist()), Vector3(*self._vertices.max(axis=0).tolist())
 
-        for v in self._vertex:
-            for j in range(0, 3):
-                min_[j] = min(min_[j], v[j])
-                max_[j] = max(max_[j], v[j])
+    def ray_intersect(self, origin, direction, t_min=0, t_max=float('inf')):
+        # nearest hit as (distance, triangle index), the bvh hands over leaves front-to-back
+        rows, _ = self._get_triangle_rows()
+        origin, direction = origin.coordinates, direction.coordinates
+        collector = stats.active
 
-        return Vector3(*min_), Vector3(*max_)
+        def leaf_intersect(primitives, t_max):
+            if len(primitives) >= self.VECTOR_BLOCK:
+                result = self._block_intersect(primitives, origin, direction, t_min, t_max)
+            else:
+                result = self._rows_intersect(rows, primitives, origin, direction, t_min, t_max)
 
-    def ray_intersect(self, origin, direction):
-        for fi, triangle in enumerate(self._triangles):
-            intersection = self.ray_triangle_intersect(fi, triangle, origin, direction)
+            if collector is not None:
+                collector.counters['tests', 'triangle'] += len(primitives)
+                collector.counters['hits', 'triangle'] += result is not None
 
-            if intersection:
-                return intersection
-            
-        return None
+            return (result[0], result) if result else None
 
-    def ray_triangle_intersect(self, fi, tri, origin, direction):
+        return self.bvh.intersect(origin, direction, leaf_intersect, t_max)
+
+    @classmethod
+    def _rows_intersect(cls, rows, primitives, origin, direction, t_min, t_max, any_hit=False):
+        # Möller–Trumbore on the precomputed rows, same arithmetic as ray_triangle_distance
+        # without building a Vector3 for every intermediate
+        ox, oy, oz = origin
+        dx, dy, dz = direction
+        result = None
+
+        for fi in primitives:
+            x0, y0, z0, e1x, e1y, e1z, e2x, e2y, e2z = rows[fi]
+
+            # pvec = direction x edge_2
+            px = dy * e2z - dz * e2y
+            py = dz * e2x - dx * e2z
+            pz = dx * e2y - dy * e2x
+
+            determinant = e1x * px + e1y * py + e1z * pz
+            if determinant < 1e-5:
+                continue
+
+            tx, ty, tz = ox - x0, oy - y0, oz - z0
+
+            u = tx * px + ty * py + tz * pz
+            if u < 0 or u > determinant:
+                continue
+
+            # qvec = tvec x edge_1
+            qx = ty * e1z - tz * e1y
+            qy = tz * e1x - tx * e1z
+            qz = tx * e1y - ty * e1x
+
+            v = dx * qx + dy * qy + dz * qz
+            if v < 0 or u + v > determinant:
+                continue
+
+            tnear = (e2x * qx + e2y * qy + e2z * qz) * (1.0 / determinant)
+
+            if tnear >= 1e-5 and t_min <= tnear < t_max:
+                if any_hit:
+                    return tnear, fi
+
+                t_max = tnear
+                result = tnear, fi
+
+        return result
+
+    @classmethod
+    def _moller_trumbore(cls, triangles, origin, direction):
+        # distances from the ray(s) to a (9, n) block of triangles, np.inf where missed.
+        # origin and direction components are floats for a single ray or (rays, 1)
+        # columns for a packet, which gives a (rays, n) result
+        x0, y0, z0, e1x, e1y, e1z, e2x, e2y, e2z = triangles
+        ox, oy, oz = origin
+        dx, dy, dz = direction
+
+        # pvec = direction x edge_2
+        px = dy * e2z - dz * e2y
+        py = dz * e2x - dx * e2z
+        pz = dx * e2y - dy * e2x
+
+        determinant = e1x * px + e1y * py + e1z * pz
+        valid = determinant >= 1e-5
+
+        tx, ty, tz = ox - x0, oy - y0, oz - z0
+
+        u = tx * px + ty * py + tz * pz
+        valid &= (u >= 0) & (u <= determinant)
+
+        # qvec = tvec x edge_1
+        qx = ty * e1z - tz * e1y
+        qy = tz * e1x - tx * e1z
+        qz = tx * e1y - ty * e1x
+
+        v = dx * qx + dy * qy + dz * qz
+        valid &= (v >= 0) & (u + v <= determinant)
+
+        tnear = (e2x * qx + e2y * qy + e2z * qz) * (1.0 / np.where(valid, determinant, 1))
+        valid &= tnear >= 1e-5
+
+        return np.where(valid, tnear, np.inf)
+
+    def _block_intersect(self, triangles, origin, direction, t_min, t_max):
+        if triangles is None:
+            tnear = self._moller_trumbore(self._triangle_soa, origin, direction)
+        else:
+            triangles = np.asarray(triangles)
+            tnear = self._moller_trumbore(self._triangle_soa[:, triangles], origin, direction)
+
+        tnear[(tnear < t_min) | (tnear >= t_max)] = np.inf
+        if not len(tnear):
+            return None
+
+        nearest = int(tnear.argmin())
+        if not np.isfinite(tnear[nearest]):
+            return None
+
+        return float(tnear[nearest]), int(nearest if triangles is None else triangles[nearest])
+
+    def ray_triangles_intersect(self, origin, direction, triangles=None, t_min=0, t_max=float('inf')):
+        # one ray against a block of triangles (all of them by default) at once, without
+        # the bvh. Returns (distance, triangle index) of the nearest hit or None
+        return self._block_intersect(triangles, origin.coordinates, direction.coordinates, t_min, t_max)
+
+    def normal_at(self, fi):
+        return self._get_triangle_rows()[1][fi]
+
+    def occluded(self, origin, direction, max_distance):
+        rows, _ = self._get_triangle_rows()
+        origin, direction = origin.coordinates, direction.coordinates
+        collector = stats.active
+
+        def leaf_occluded(primitives, t_max):
+            if collector is not None:
+                collector.counters['tests', 'triangle'] += len(primitives)
+
+            if len(primitives) >= self.VECTOR_BLOCK:
+                return self._block_intersect(primitives, origin, direction, 0, t_max) is not None
+
+            return self._rows_intersect(rows, primitives, origin, direction, 0, t_max, any_hit=True) is not None
+
+        return self.bvh.occluded(origin, direction, leaf_occluded, max_distance)
+
+    def ray_triangle_distance(self, tri, origin, direction):
         edge_1 = tri[1] - tri[0]
         edge_2 = tri[2] - tri[0]
 
@@ -94,7 +319,86 @@ class Model(object):
         if tnear < 1e-5:
             return None
 
-        normal = self._cross(edge_1, edge_2).normalize()
-        return tnear, origin + tnear * direction, normal
+        return tnear
+
+    def ray_triangle_intersect(self, fi, tri, origin, direction):
+        tnear = self.ray_triangle_distance(tri, origin, direction)
+
+        if tnear is None:
+            return None
+
+        return tnear, origin + tnear * direction, self.normal_at(fi)
+
+    def _get_triangle_arrays(self):
+        # (triangles, 3) views of v0, edge_1, edge_2 and the normals
+        soa = self._triangle_soa
+        return soa[0:3].T, soa[3:6].T, soa[6:9].T, self._normals
+
+    def _triangles_intersect_packet(self, triangles, origins, directions, t_max=None):
+        # nearest hit of every ray against the given triangles closer than t_max
+        block = self._triangle_soa[:, triangles]
+
+        count = len(origins)
+        distances = np.full(count, np.inf)
+        primitives = np.full(count, -1, dtype=np.int64)
+
+        # keep the (rays x triangles) temporaries around a million elements
+        chunk = max(1, (1 << 20) // max(1, block.shape[1]))
+
+        for start in range(0, count, chunk):
+            stop = min(count, start + chunk)
+            # (3, rays, 1) so every component broadcasts against the triangle rows
+            origin = origins[start:stop].T[:, :, None]
+            direction = directions[start:stop].T[:, :, None]
+
+            tnear = self._moller_trumbore(block, origin, direction)
+            if t_max is not None:
+                tnear[tnear >= t_max[start:stop, None]] = np.inf
+
+            nearest = tnear.argmin(axis=1)
+            rows = np.arange(stop - start)
+
+            distances[start:stop] = tnear[rows, nearest]
+            primitives[start:stop] = np.where(np.isfinite(distances[start:stop]), triangles[nearest], -1)
+
+        return distances, primitives
+
+    def ray_intersect_packet(self, origins, directions, t_max=None):
+        if self._scalar_packet(len(origins)):
+            return self._rays_intersect(origins, directions, t_max)
+
+        return self.bvh.intersect_packet(origins, directions, self._triangles_intersect_packet, t_max)
+
+    def occluded_packet(self, origins, directions, max_distances):
+        if self._scalar_packet(len(origins)):
+            return np.array([self.occluded(Vector3(*origin), Vector3(*direction), max_distance)
+                             for origin, direction, max_distance in zip(origins.tolist(), directions.tolist(),
+                                                                         max_distances.tolist())], dtype=bool)
+
+        def leaf_occluded(triangles, origins, directions, t_max):
+            return np.isfinite(self._triangles_intersect_packet(triangles, origins, directions, t_max)[0])
+
+        return self.bvh.occluded_packet(origins, directions, leaf_occluded, max_distances)
+
+    def _scalar_packet(self, count):
+        # walking the tree with numpy only pays off with many rays per node: packets with
+        # fewer rays than the tree has nodes go through the single ray traversal one by one
+        return count < len(self.bvh.node_count)
+
+    def _rays_intersect(self, origins, directions, t_max=None):
+        # a few rays one by one through the scalar traversal
+        count = len(origins)
+        distances = np.full(count, np.inf)
+        primitives = np.full(count, -1, dtype=np.int64)
+        t_max = np.broadcast_to(np.inf if t_max is None else t_max, (count,)).tolist()
+
+        for index, (origin, direction) in enumerate(zip(origins.tolist(), directions.tolist())):
+            hit = self.ray_intersect(Vector3(*origin), Vector3(*direction), 0, t_max[index])
+
+            if hit is not None:
+                distances[index], primitives[index] = hit
+
+        return distances, primitives
 
-    
+    def normals_packet(self, primitives):
+        return self._normals[primitives]
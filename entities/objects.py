@@ -1,21 +1,80 @@
 import math
+import hashlib
+
+import numpy as np
+
+import stats
+import utils
 
 from .base import Vector3, Vector4
-from .materials import Material
+from .bvh import BVH
+from .materials import Material, MaterialPacket
+from .transform import Transform
 
 class SceneObject(object):
-    def _ray_intersect(self, origin, direction):
+    # ray_intersect only looks for the hit and returns (distance, primitive) or None,
+    # the full SceneIntersectionObject is built by surface_at for the closest hit only.
+    # Hits outside [t_min, t_max) are not reported, so callers pass the best distance
+    # found so far and objects can give up early. No state of its own: subclasses with
+    # __slots__ (MeshInstance, of which scenes hold thousands) really go without a __dict__
+    __slots__ = ()
+
+    def _ray_intersect(self, origin, direction, t_min, t_max):
         raise NotImplementedError
 
-    def ray_intersect(self, origin, direction):
-        return self._ray_intersect(origin, direction)
+    def ray_intersect(self, origin, direction, t_min=0, t_max=float('inf')):
+        return self._ray_intersect(origin, direction, t_min, t_max)
+
+    def surface_at(self, origin, direction, distance, primitive):
+        point = origin + direction * distance
+        return SceneIntersectionObject(distance, point, self.get_normal_at(point), self.material)
+
+    def occluded(self, origin, direction, max_distance):
+        return self.ray_intersect(origin, direction, t_max=max_distance) is not None
 
     def get_normal_at(self, point):
         raise NotImplementedError
 
+    def get_bbox(self):
+        # (lower, upper) corners, None for objects without finite bounds
+        return None
+
+    def prepare(self):
+        pass
+
+    def geometry_key(self):
+        # changes whenever what rays see of the object changes (shape, placement or
+        # material). Objects that don't know better are only equal to themselves
+        return type(self).__name__, id(self)
+
+    def ray_intersect_packet(self, origins, directions, t_max=None):
+        # returns (distances, primitives); distance is np.inf where the ray misses or
+        # the hit is not closer than t_max
+        count = len(origins)
+        distances = np.full(count, np.inf)
+        primitives = np.zeros(count, dtype=np.int64)
+        t_max = np.broadcast_to(np.inf if t_max is None else t_max, (count,))
+
+        for index in range(count):
+            hit = self.ray_intersect(Vector3(*origins[index]), Vector3(*directions[index]), t_max=t_max[index])
+
+            if hit is not None:
+                distances[index], primitives[index] = hit
+
+        return distances, primitives
+
+    def occluded_packet(self, origins, directions, max_distances):
+        distances, _ = self.ray_intersect_packet(origins, directions, max_distances)
+        return np.isfinite(distances)
+
+    def surface_packet(self, points, primitives):
+        # returns (normals, materials) for a batch of hits on this object
+        normals = np.array([self.get_normal_at(Vector3(*point)).coordinates for point in points], dtype=float)
+        return normals, self.material.packet(len(points))
+
 
 class SceneIntersectionObject(object):
-    __slots__ = ('point', 'normal', 'material', 'distance')
+    __slots__ = ('point', 'normal', 'material', 'distance', 'object_index')
 
     def __init__(self, distance, point, normal, material):
         self.distance = distance
@@ -23,6 +82,9 @@ class SceneIntersectionObject(object):
         self.normal = normal
         self.material = material
 
+        # index of the hit object in the scene, filled in by Scene.intersect
+        self.object_index = -1
+
 
 class Panel(SceneObject):
     def __init__(self, center, width, height, material=None):
@@ -35,17 +97,17 @@ class Panel(SceneObject):
         self._first_material = Material(Vector4(1, 0, 0, 0), color=color_1)
         self._second_material = Material(Vector4(1, 0, 0, 0), color=color_2)
 
-    def _ray_intersect(self, origin, direction):
-        
+    def _ray_intersect(self, origin, direction, t_min, t_max):
         if abs(direction.y) <=  1e-3:
             return None
 
         d = -(origin.y - self.center.y) / direction.y
-        pt = origin + direction * d
 
-        if d < 0:
+        if d < t_min or d >= t_max:
             return None
 
+        pt = origin + direction * d
+
         if self.center.x - self.width / 2 > pt.x:
             return None
 
@@ -58,6 +120,10 @@ class Panel(SceneObject):
         if self.center.z + self.height / 2 < pt.z:
             return None
 
+        return d, 0
+
+    def surface_at(self, origin, direction, distance, primitive):
+        pt = origin + direction * distance
         normal = self.get_normal_at(pt)
 
         if (int(.5 * pt.x + 1000) + int(.5 * pt.z)) & 1:
@@ -65,11 +131,46 @@ class Panel(SceneObject):
         else:
             material = self._second_material
 
-        return SceneIntersectionObject(d, pt, normal, material)
+        return SceneIntersectionObject(distance, pt, normal, material)
 
     def get_normal_at(self, pt):
         return Vector3(0, 1, 0)
 
+    def geometry_key(self):
+        return 'Panel', tuple(self.center.coordinates), self.width, self.height
+
+    def get_bbox(self):
+        return (Vector3(self.center.x - self.width / 2, self.center.y, self.center.z - self.height / 2),
+                Vector3(self.center.x + self.width / 2, self.center.y, self.center.z + self.height / 2))
+
+    def ray_intersect_packet(self, origins, directions, t_max=None):
+        dir_y = directions[:, 1]
+        valid = np.abs(dir_y) > 1e-3
+
+        with np.errstate(divide='ignore', invalid='ignore'):
+            d = -(origins[:, 1] - self.center.y) / np.where(valid, dir_y, 1)
+
+        pt = origins + directions * d[:, None]
+
+        valid &= d >= 0
+        if t_max is not None:
+            valid &= d < t_max
+        valid &= pt[:, 0] >= self.center.x - self.width / 2
+        valid &= pt[:, 0] <= self.center.x + self.width / 2
+        valid &= pt[:, 2] >= self.center.z - self.height / 2
+        valid &= pt[:, 2] <= self.center.z + self.height / 2
+
+        return np.where(valid, d, np.inf), np.zeros(len(origins), dtype=np.int64)
+
+    def surface_packet(self, points, primitives):
+        count = len(points)
+        normals = np.tile(np.array([0.0, 1.0, 0.0]), (count, 1))
+
+        checker = (np.trunc(.5 * points[:, 0] + 1000).astype(np.int64) + np.trunc(.5 * points[:, 2]).astype(np.int64)) & 1
+        materials = MaterialPacket.where(checker == 1, self._first_material.packet(count), self._second_material.packet(count))
+
+        return normals, materials
+
 
 class Box(SceneObject):
     __slots__ = ('bounds', 'material')
@@ -81,51 +182,69 @@ class Box(SceneObject):
     def get_nortmal_at(self, point):
         pass
 
-    def _ray_intersect(self, origin, dir):
-        axes = 0
-        tmin = (self.bounds[0].x - origin.x) / dir.x
-        tmax = (self.bounds[1].x - origin.x) / dir.x
+    def geometry_key(self):
+        return 'Box', tuple(self.bounds[0].coordinates), tuple(self.bounds[1].coordinates), self.material.key()
 
-        tmin, tmax = min(tmin, tmax), max(tmin, tmax)
+    def get_bbox(self):
+        return self.bounds[0], self.bounds[1]
 
-        tymin = (self.bounds[0].y - origin.y) / dir.y
-        tymax = (self.bounds[1].y - origin.y) / dir.y
+    def ray_intersect(self, origin, dir, t_min=0, t_max=float('inf')):
+        hit = self._ray_intersect(origin, dir, t_min, t_max)
 
-        tymin, tymax = min(tymin, tymax), max(tymin, tymax)
+        collector = stats.active
+        if collector is not None:
+            collector.counters['tests', 'bbox'] += 1
+            collector.counters['rejections', 'bbox'] += hit is None
 
-        if tmin > tymax or tymin > tmax:
-            return None
+        return hit
 
-        tmin = max(tymin, tmin)
-        tmax = min(tymax, tmax)
+    def _ray_intersect(self, origin, dir, t_min, t_max):
+        # returns (entry, exit) distances of the ray inside the box clipped to [t_min, t_max],
+        # None if the box is missed, behind the origin or farther than t_max
+        tmin, tmax = t_min, t_max
 
-        if tmin == tymin:
-            axes = 1
+        origin = origin.coordinates
+        dir = dir.coordinates
+        lower = self.bounds[0].coordinates
+        upper = self.bounds[1].coordinates
 
-        tzmin = (self.bounds[0].z - origin.z) / dir.z
-        tzmax = (self.bounds[1].z - origin.z) / dir.z
+        for axis in range(3):
+            if dir[axis]:
+                inverse = 1.0 / dir[axis]
+                t1 = (lower[axis] - origin[axis]) * inverse
+                t2 = (upper[axis] - origin[axis]) * inverse
 
-        tzmin, tzmax = min(tzmin, tzmax), max(tzmin, tzmax)
+                if t1 > t2:
+                    t1, t2 = t2, t1
 
-        if tmin > tzmax or tzmin > tmax:
-            return None
+                tmin = max(tmin, t1)
+                tmax = min(tmax, t2)
+            elif not lower[axis] <= origin[axis] <= upper[axis]:
+                return None
+
+            if tmin > tmax:
+                return None
+
+        return tmin, tmax
+
+    def ray_intersect_packet(self, origins, directions, t_max=None):
+        # slab test for a batch of rays, returns (entry, exit) distances; entry is np.inf
+        # for rays that miss the box
+        lower = np.array(self.bounds[0].coordinates, dtype=float)
+        upper = np.array(self.bounds[1].coordinates, dtype=float)
 
-        tmin = max(tzmin, tmin)
-        tmax = min(tzmax, tmax)
+        with np.errstate(divide='ignore'):
+            inverse = np.where(directions != 0, 1.0 / np.where(directions != 0, directions, 1), 1e30)
 
-        if tmin == tzmin:
-            axes = 2
+        t1 = (lower - origins) * inverse
+        t2 = (upper - origins) * inverse
 
-        # if axes == 0:
-        #     normal = Vector3(1, 0, 0)
-        # elif axes == 1:
-        #     normal = Vector3(0, 1, 0)
-        # else:
-        #     normal = Vector3(0, 0, 1)
-        #
-        # return SceneIntersectionObject(tmin, dir * tmin, normal, self.material)
+        tmin = np.maximum(np.minimum(t1, t2).max(axis=1), 0)
+        tmax = np.maximum(t1, t2).min(axis=1)
+        if t_max is not None:
+            tmax = np.minimum(tmax, t_max)
 
-        return True
+        return np.where(tmin <= tmax, tmin, np.inf), tmax
 
 
 class Sphere(SceneObject):
@@ -139,7 +258,14 @@ class Sphere(SceneObject):
     def get_normal_at(self, point):
         return (point - self.center).normalize()
 
-    def _ray_intersect(self, origin, dir):
+    def geometry_key(self):
+        return 'Sphere', tuple(self.center.coordinates), self.radius, self.material.key()
+
+    def get_bbox(self):
+        radius = Vector3(self.radius, self.radius, self.radius)
+        return self.center - radius, self.center + radius
+
+    def _ray_intersect(self, origin, dir, t_min, t_max):
         # vector from origin to sphere center
         v = self.center - origin
 
@@ -160,17 +286,36 @@ class Sphere(SceneObject):
         intersection = pc_signed_proj - delta
 
         # if intersection behind the orig - try another
-        if intersection < 0:
+        if intersection < t_min:
             intersection = pc_signed_proj + delta
 
         # if intersection behind the orig - don't register intersection
-        if intersection < 0:
+        if intersection < t_min or intersection >= t_max:
             return None
 
-        point = origin + dir * intersection
-        normal = self.get_normal_at(point)
+        return intersection, 0
+
+    def ray_intersect_packet(self, origins, directions, t_max=None):
+        v = np.array(self.center.coordinates, dtype=float) - origins
+        pc_signed_proj = utils.dot_packet(directions, v)
+
+        dist = utils.dot_packet(v, v) - pc_signed_proj * pc_signed_proj
+        valid = dist <= self.radius ** 2
+
+        delta = np.sqrt(np.where(valid, self.radius ** 2 - dist, 0))
+
+        intersection = pc_signed_proj - delta
+        intersection = np.where(intersection < 0, pc_signed_proj + delta, intersection)
+
+        valid &= intersection >= 0
+        if t_max is not None:
+            valid &= intersection < t_max
+
+        return np.where(valid, intersection, np.inf), np.zeros(len(origins), dtype=np.int64)
 
-        return SceneIntersectionObject(intersection, point, normal, self.material)
+    def surface_packet(self, points, primitives):
+        normals = utils.normalize_packet(points - np.array(self.center.coordinates, dtype=float))
+        return normals, self.material.packet(len(points))
 
 class Duck(SceneObject):
     def __init__(self, center, model, material):
@@ -180,16 +325,363 @@ class Duck(SceneObject):
 
         self._box = Box(*self._model.get_bbox())
 
-    def _bbox_intersection(self, origin, direction):
-        return self._box.ray_intersect(origin, direction)
+    def get_bbox(self):
+        return self._box.get_bbox()
 
-    def _ray_intersect(self, origin, direction):
-        if not self._bbox_intersection(origin, direction):
+    def prepare(self):
+        self._model.bvh
+
+    def geometry_key(self):
+        return 'Duck', self._model.key(), tuple(self._center.coordinates), self._material.key()
+
+    def _bbox_intersection(self, origin, direction, t_min=0, t_max=float('inf')):
+        return self._box.ray_intersect(origin, direction, t_min, t_max)
+
+    def _ray_intersect(self, origin, direction, t_min, t_max):
+        # skip the mesh when the box is missed, behind the ray or behind a closer hit
+        if not self._bbox_intersection(origin, direction, t_min, t_max):
             return None
 
-        intersection = self._model.ray_intersect(origin, direction)
+        return self._model.ray_intersect(origin, direction, t_min, t_max)
 
-        if intersection:
-            return SceneIntersectionObject(*intersection, self._material)
+    def surface_at(self, origin, direction, distance, primitive):
+        point = origin + direction * distance
+        return SceneIntersectionObject(distance, point, self._model.normal_at(primitive), self._material)
 
-        return None
+    def occluded(self, origin, direction, max_distance):
+        if not self._bbox_intersection(origin, direction, t_max=max_distance):
+            return False
+
+        return self._model.occluded(origin, direction, max_distance)
+
+    def ray_intersect_packet(self, origins, directions, t_max=None):
+        distances = np.full(len(origins), np.inf)
+        primitives = np.full(len(origins), -1, dtype=np.int64)
+
+        entry, _ = self._box.ray_intersect_packet(origins, directions, t_max)
+        candidates = np.nonzero(np.isfinite(entry))[0]
+
+        if len(candidates):
+            distances[candidates], primitives[candidates] = self._model.ray_intersect_packet(
+                origins[candidates], directions[candidates],
+                None if t_max is None else np.broadcast_to(t_max, (len(origins),))[candidates])
+
+        return distances, primitives
+
+    def occluded_packet(self, origins, directions, max_distances):
+        occluded = np.zeros(len(origins), dtype=bool)
+
+        entry, _ = self._box.ray_intersect_packet(origins, directions, max_distances)
+        candidates = np.nonzero(np.isfinite(entry))[0]
+
+        if len(candidates):
+            occluded[candidates] = self._model.occluded_packet(
+                origins[candidates], directions[candidates], max_distances[candidates])
+
+        return occluded
+
+    def surface_packet(self, points, primitives):
+        return self._model.normals_packet(primitives), self._material.packet(len(points))
+
+
+class MeshInstance(SceneObject):
+    # a placed copy of a shared Model: triangles and their bvh belong to the model, an
+    # instance only adds a transform and a material. Rays are moved into the space of
+    # the model instead of the triangles into the world; directions are not normalized
+    # there, so hit distances are the same in both spaces
+    __slots__ = ('model', 'material', '_transform', '_bbox', '_to_model', '_normal_rows')
+
+    def __init__(self, model, transform=None, material=None):
+        self.model = model
+        self.material = material or Material()
+        self.transform = transform or Transform()
+
+    @property
+    def transform(self):
+        return self._transform
+
+    @transform.setter
+    def transform(self, transform):
+        self._transform = transform
+        self._bbox = transform.bbox(*self.model.get_bbox())
+
+        # rows of the inverse for the scalar path, normals go through its transpose
+        self._to_model = [tuple(row) for row in transform.inverse[:3].tolist()]
+        self._normal_rows = [tuple(row) for row in transform.inverse[:3, :3].T.tolist()]
+
+    def get_bbox(self):
+        return self._bbox
+
+    def prepare(self):
+        self.model.bvh
+
+    def geometry_key(self):
+        return 'MeshInstance', self.model.key(), self._transform.key(), self.material.key()
+
+    def _model_ray(self, origin, direction):
+        (a, b, c, tx), (d, e, f, ty), (g, h, i, tz) = self._to_model
+        ox, oy, oz = origin.coordinates
+        dx, dy, dz = direction.coordinates
+
+        return (Vector3(a * ox + b * oy + c * oz + tx, d * ox + e * oy + f * oz + ty, g * ox + h * oy + i * oz + tz),
+                Vector3(a * dx + b * dy + c * dz, d * dx + e * dy + f * dz, g * dx + h * dy + i * dz))
+
+    def _model_rays(self, origins, directions):
+        inverse = self._transform.inverse
+
+        return origins @ inverse[:3, :3].T + inverse[:3, 3], directions @ inverse[:3, :3].T
+
+    def _ray_intersect(self, origin, direction, t_min, t_max):
+        origin, direction = self._model_ray(origin, direction)
+        return self.model.ray_intersect(origin, direction, t_min, t_max)
+
+    def occluded(self, origin, direction, max_distance):
+        origin, direction = self._model_ray(origin, direction)
+        return self.model.occluded(origin, direction, max_distance)
+
+    def surface_at(self, origin, direction, distance, primitive):
+        point = origin + direction * distance
+        nx, ny, nz = self.model.normal_at(primitive).coordinates
+        (a, b, c), (d, e, f), (g, h, i) = self._normal_rows
+
+        normal = Vector3(a * nx + b * ny + c * nz, d * nx + e * ny + f * nz, g * nx + h * ny + i * nz)
+
+        return SceneIntersectionObject(distance, point, normal.normalize(), self.material)
+
+    def ray_intersect_packet(self, origins, directions, t_max=None):
+        return self.model.ray_intersect_packet(*self._model_rays(origins, directions), t_max)
+
+    def occluded_packet(self, origins, directions, max_distances):
+        return self.model.occluded_packet(*self._model_rays(origins, directions), max_distances)
+
+    def surface_packet(self, points, primitives):
+        normals = self.model.normals_packet(primitives) @ self._transform.inverse[:3, :3]
+        return utils.normalize_packet(normals), self.material.packet(len(points))
+
+
+class SphereSet(SceneObject):
+    # many spheres as one object: centres, radii and material indices are contiguous
+    # arrays under a bvh of their own, so the scene sees a single object and the
+    # spheres are tested a leaf of the tree at a time. The primitive of a hit is the
+    # index of the sphere
+    def __init__(self, centers, radii, materials, material_indices=None, leaf_size=4):
+        centers = np.array(centers, dtype=float).reshape(-1, 3)
+        if not len(centers):
+            raise ValueError("SphereSet needs at least one sphere")
+
+        self._leaf_size = leaf_size
+        self._bvh = None
+
+        self._centers = self._read_only(centers)
+        self._radii = self._read_only(np.broadcast_to(radii, (len(centers),)))
+        self._update_rows()
+
+        self.materials = materials
+        self.material_indices = np.zeros(len(centers), dtype=np.int64) if material_indices is None else material_indices
+
+    # the arrays can't be changed in place, assigning a new one updates what is derived
+    # from it: rows and bvh of the spheres, the material arrays
+    @staticmethod
+    def _read_only(array, dtype=float):
+        array = np.array(array, dtype=dtype)
+        array.flags.writeable = False
+
+        return array
+
+    def _check_count(self, array):
+        if len(array) != len(self._centers):
+            raise ValueError("SphereSet has {} spheres, got {} values".format(len(self._centers), len(array)))
+
+    @property
+    def centers(self):
+        return self._centers
+
+    @centers.setter
+    def centers(self, centers):
+        centers = self._read_only(np.asarray(centers, dtype=float).reshape(-1, 3))
+        self._check_count(centers)
+
+        self._centers = centers
+        self._update_rows()
+
+    @property
+    def radii(self):
+        return self._radii
+
+    @radii.setter
+    def radii(self, radii):
+        self._radii = self._read_only(np.broadcast_to(radii, (len(self._centers),)))
+        self._update_rows()
+
+    @property
+    def materials(self):
+        return self._materials
+
+    @materials.setter
+    def materials(self, materials):
+        self._materials = list(materials) if isinstance(materials, (list, tuple)) else [materials]
+
+        # the materials as arrays, a packet of hits indexes them by material index
+        self._material_arrays = (
+            np.array([material.diffuse_color.coordinates for material in self._materials], dtype=float),
+            np.array([material.albedo.coordinates for material in self._materials], dtype=float),
+            np.array([material.specular_exponent for material in self._materials], dtype=float),
+            np.array([material.refractive_index for material in self._materials], dtype=float),
+        )
+
+    @property
+    def material_indices(self):
+        return self._material_indices
+
+    @material_indices.setter
+    def material_indices(self, material_indices):
+        self._material_indices = self._read_only(np.broadcast_to(material_indices, (len(self._centers),)), np.int64)
+
+    def _update_rows(self):
+        # (centre x, y, z, radius^2) rows for the single ray loops
+        self._rows = [tuple(row) for row in np.column_stack((self._centers, self._radii ** 2)).tolist()]
+
+        # moved spheres are refitted into the tree built for where they were
+        if self._bvh is not None:
+            self._bvh.refit(self._centers - self._radii[:, None], self._centers + self._radii[:, None])
+
+    def __len__(self):
+        return len(self._centers)
+
+    @property
+    def bvh(self):
+        if self._bvh is None:
+            self._bvh = BVH(self._centers - self._radii[:, None], self._centers + self._radii[:, None],
+                            leaf_size=self._leaf_size)
+
+        return self._bvh
+
+    def prepare(self):
+        self.bvh
+
+    def get_bbox(self):
+        return (Vector3(*(self.centers - self.radii[:, None]).min(axis=0).tolist()),
+                Vector3(*(self.centers + self.radii[:, None]).max(axis=0).tolist()))
+
+    def geometry_key(self):
+        digest = hashlib.blake2b(digest_size=16)
+        for array in (self.centers, self.radii, self.material_indices):
+            digest.update(array.tobytes())
+
+        return 'SphereSet', digest.hexdigest(), tuple(material.key() for material in self.materials)
+
+    def _rows_intersect(self, primitives, origin, direction, t_min, t_max, any_hit=False):
+        # same arithmetic as Sphere._ray_intersect on plain floats
+        rows = self._rows
+        ox, oy, oz = origin
+        dx, dy, dz = direction
+        result = None
+
+        for index in primitives:
+            cx, cy, cz, radius2 = rows[index]
+            vx, vy, vz = cx - ox, cy - oy, cz - oz
+
+            projection = dx * vx + dy * vy + dz * vz
+            dist = vx * vx + vy * vy + vz * vz - projection * projection
+            if dist > radius2:
+                continue
+
+            delta = math.sqrt(radius2 - dist)
+
+            intersection = projection - delta
+            if intersection < t_min:
+                intersection = projection + delta
+            if intersection < t_min or intersection >= t_max:
+                continue
+
+            if any_hit:
+                return intersection, index
+
+            t_max = intersection
+            result = intersection, index
+
+        return result
+
+    def _ray_intersect(self, origin, direction, t_min, t_max):
+        origin, direction = origin.coordinates, direction.coordinates
+        collector = stats.active
+
+        def leaf_intersect(primitives, t_max):
+            result = self._rows_intersect(primitives, origin, direction, t_min, t_max)
+
+            if collector is not None:
+                collector.counters['tests', 'sphere'] += len(primitives)
+                collector.counters['hits', 'sphere'] += result is not None
+
+            return (result[0], result) if result else None
+
+        return self.bvh.intersect(origin, direction, leaf_intersect, t_max)
+
+    def occluded(self, origin, direction, max_distance):
+        origin, direction = origin.coordinates, direction.coordinates
+        collector = stats.active
+
+        def leaf_occluded(primitives, t_max):
+            if collector is not None:
+                collector.counters['tests', 'sphere'] += len(primitives)
+
+            return self._rows_intersect(primitives, origin, direction, 0, t_max, any_hit=True) is not None
+
+        return self.bvh.occluded(origin, direction, leaf_occluded, max_distance)
+
+    def surface_at(self, origin, direction, distance, primitive):
+        point = origin + direction * distance
+        cx, cy, cz, _ = self._rows[primitive]
+        normal = (point - Vector3(cx, cy, cz)).normalize()
+
+        return SceneIntersectionObject(distance, point, normal, self.materials[self.material_indices[primitive]])
+
+    def _spheres_intersect_packet(self, spheres, origins, directions, t_max=None):
+        # nearest hit of every ray against the given spheres closer than t_max
+        v = self.centers[spheres][None, :, :] - origins[:, None, :]
+        projection = utils.dot_packet(directions[:, None, :], v)
+        dist = utils.dot_packet(v, v) - projection * projection
+
+        radius2 = self.radii[spheres] ** 2
+        valid = dist <= radius2
+
+        delta = np.sqrt(np.where(valid, radius2 - dist, 0))
+        intersection = projection - delta
+        intersection = np.where(intersection < 0, projection + delta, intersection)
+
+        valid &= intersection >= 0
+        if t_max is not None:
+            valid &= intersection < t_max[:, None]
+
+        intersection = np.where(valid, intersection, np.inf)
+        nearest = intersection.argmin(axis=1)
+        distances = intersection[np.arange(len(origins)), nearest]
+
+        return distances, np.where(np.isfinite(distances), spheres[nearest], -1)
+
+    def ray_intersect_packet(self, origins, directions, t_max=None):
+        if len(origins) < len(self.bvh.node_count):
+            # too few rays to walk the tree with numpy, see Model._scalar_packet
+            return super(SphereSet, self).ray_intersect_packet(origins, directions, t_max)
+
+        return self.bvh.intersect_packet(origins, directions, self._spheres_intersect_packet, t_max)
+
+    def occluded_packet(self, origins, directions, max_distances):
+        if len(origins) < len(self.bvh.node_count):
+            return np.array([self.occluded(Vector3(*origin), Vector3(*direction), max_distance)
+                             for origin, direction, max_distance in zip(origins.tolist(), directions.tolist(),
+                                                                         max_distances.tolist())], dtype=bool)
+
+        def leaf_occluded(spheres, origins, directions, t_max):
+            return np.isfinite(self._spheres_intersect_packet(spheres, origins, directions, t_max)[0])
+
+        return self.bvh.occluded_packet(origins, directions, leaf_occluded, max_distances)
+
+    def surface_packet(self, points, primitives):
+        normals = utils.normalize_packet(points - self.centers[primitives])
+
+        materials = self.material_indices[primitives]
+        diffuse_color, albedo, specular_exponent, refractive_index = self._material_arrays
+
+        return normals, MaterialPacket(diffuse_color[materials], albedo[materials],
+                                       specular_exponent[materials], refractive_index[materials])
@@ -0,0 +1,71 @@
+import math
+
+import numpy as np
+
+from .base import Vector3
+
+
+class Transform(object):
+    # affine transform kept as a 4x4 matrix together with its inverse. Transforms compose
+    # with *, the right hand side is applied first:
+    #     Transform.translation(offset) * Transform.scaling(2)
+    # scales first and then moves
+    __slots__ = ('matrix', 'inverse')
+
+    def __init__(self, matrix=None, inverse=None):
+        self.matrix = np.identity(4) if matrix is None else np.array(matrix, dtype=float)
+        self.inverse = np.linalg.inv(self.matrix) if inverse is None else np.array(inverse, dtype=float)
+
+    @classmethod
+    def translation(cls, offset):
+        matrix, inverse = np.identity(4), np.identity(4)
+        matrix[:3, 3] = offset.coordinates
+        inverse[:3, 3] = (-offset).coordinates
+
+        return cls(matrix, inverse)
+
+    @classmethod
+    def scaling(cls, factor):
+        # factor is a number or a Vector3 of per axis factors
+        factors = np.broadcast_to(np.array(getattr(factor, 'coordinates', factor), dtype=float), (3,))
+
+        if not factors.all():
+            raise ValueError("Scaling by zero can't be inverted")
+
+        return cls(np.diag(np.append(factors, 1)), np.diag(np.append(1 / factors, 1)))
+
+    @classmethod
+    def rotation(cls, axis, angle):
+        # counterclockwise by angle radians around axis, looking against it
+        x, y, z = axis.normalize().coordinates
+        c, s = math.cos(angle), math.sin(angle)
+
+        matrix = np.identity(4)
+        matrix[:3, :3] = [
+            [c + x * x * (1 - c), x * y * (1 - c) - z * s, x * z * (1 - c) + y * s],
+            [y * x * (1 - c) + z * s, c + y * y * (1 - c), y * z * (1 - c) - x * s],
+            [z * x * (1 - c) - y * s, z * y * (1 - c) + x * s, c + z * z * (1 - c)],
+        ]
+
+        return cls(matrix, matrix.T)
+
+    def __mul__(self, other):
+        return Transform(self.matrix @ other.matrix, other.inverse @ self.inverse)
+
+    def __repr__(self):
+        return '<Transform: {}>'.format(self.matrix[:3].tolist())
+
+    def key(self):
+        return tuple(self.matrix[:3].ravel().tolist())
+
+    def points(self, points):
+        # (n, 3) points
+        return points @ self.matrix[:3, :3].T + self.matrix[:3, 3]
+
+    def bbox(self, lower, upper):
+        # axis aligned box around the transformed box (lower, upper)
+        corners = np.array([[(lower, upper)[(corner >> axis) & 1][axis] for axis in range(3)]
+                            for corner in range(8)], dtype=float)
+        corners = self.points(corners)
+
+        return Vector3(*corners.min(axis=0).tolist()), Vector3(*corners.max(axis=0).tolist())
@@ -1,18 +1,12 @@
-from PIL import Image
-
+from cache import AssetCache
 from scene import Scene
 from renderer import Renderer
+from stats import write_heatmap
 
 from entities import Vector3, Vector4, Sphere, Light, Material, Panel, Box
 from entities.objects import Duck
 from entities.model import Model
-
-
-def write_ppm(filename, frame):
-    with open(filename, 'wb') as f:
-        f.write('P6\n{} {}\n255\n'.format(frame.width, frame.height).encode())
-        for line_bytes in frame.bytes:
-            f.write(line_bytes)
+from entities.envmap import EnvironmentMap
 
 
 def add_lights(scene):
@@ -28,14 +22,15 @@ def add_lights(scene):
     return scene
 
 
-def add_objects(scene):
+def add_objects(scene, cache=None):
     ivory = Material(Vector4(0.6, 0.3, 0.1, 0), Vector3(0.4, 0.4, 0.3), 50.0, 1.0)
     red_rubber = Material(Vector4(0.9, 0.1, 0, 0), Vector3(0.3, 0.1, 0.1), 10.0, 1.0)
 
     glass = Material(Vector4(0.0, 0.5, 0.1, 0.8), Vector3(0.6, 0.7, 0.8), 125.0, 1.5)
     mirror = Material(Vector4(0.0, 10.0, 0.8, 0), Vector3(1.0, 1.0, 1.0), 1425.0, 1.0)
     
-    model = Model('duck.obj')
+    model = Model('duck.obj', cache=cache)
+    print('[MODEL LOADED triangles=%d] %s' % (model.triangles_count(), model.bvh))
     duck = Duck(Vector3(-3, 0, -16), model, glass)
 
     objects = [
@@ -62,18 +57,24 @@ def main():
         'light': True,
         'specular_light': True,
         'envmap': True,
+        'stats': False,
     }
     renderer = Renderer(800, 600, options)
 
-    envmap = Image.open("envmap.jpg")
+    cache = AssetCache('.cache')
+
+    envmap = EnvironmentMap.open('envmap.jpg', cache=cache)
     scene = Scene(envmap)
 
     add_lights(scene)
-    add_objects(scene)
+    add_objects(scene, cache)
 
     frame = renderer.render(scene)
 
-    write_ppm('output/out_new.ppm', frame)
+    frame.save('output/out_new.ppm')
+
+    if renderer.stats is not None:
+        write_heatmap('output/out_new_cost.ppm', renderer.stats.pixel_cost)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,312 @@
+from collections import Counter
+
+import numpy as np
+
+from entities.materials import MaterialPacket
+
+import stats
+import utils
+
+
+class RayPacket(object):
+    # a batch of rays in flight, every ray remembers the pixel it contributes to
+    # and the weight of its contribution (product of albedos along the ray tree)
+    __slots__ = ('pixels', 'origins', 'directions', 'throughput')
+
+    def __init__(self, pixels, origins, directions, throughput):
+        self.pixels = pixels
+        self.origins = origins
+        self.directions = directions
+        self.throughput = throughput
+
+    def __len__(self):
+        return len(self.pixels)
+
+    def take(self, indices):
+        return RayPacket(self.pixels[indices], self.origins[indices],
+                         self.directions[indices], self.throughput[indices])
+
+    @classmethod
+    def concatenate(cls, packets):
+        return cls(
+            np.concatenate([p.pixels for p in packets]),
+            np.concatenate([p.origins for p in packets]),
+            np.concatenate([p.directions for p in packets]),
+            np.concatenate([p.throughput for p in packets]),
+        )
+
+
+class PacketSurface(object):
+    __slots__ = ('points', 'normals', 'materials')
+
+    def __init__(self, points, normals, materials):
+        self.points = points
+        self.normals = normals
+        self.materials = materials
+
+
+class GBuffer(object):
+    # the light independent part of a render: every hit of the ray tree (with the pixel,
+    # direction and throughput of the ray that made it) and the environment seen by the
+    # rays that left the scene. Lights only change the shading of these hits, so a new
+    # lighting setup is rendered from here tracing nothing but shadow rays. Shadow rays
+    # are kept per light position too, a light that didn't move costs no rays at all
+    def __init__(self, key, pixel_count):
+        self.key = key
+        self.hits = []
+        self.background = np.zeros((pixel_count, 3))
+
+        # object hit by the camera ray of every pixel, -1 for none
+        self.ids = np.full(pixel_count, -1, dtype=np.int32)
+
+    def __len__(self):
+        return sum(len(rays) for rays, _, _, _ in self.hits)
+
+    def add_hits(self, rays, surface, depth, pixel_offset=0):
+        # returns the {light position: lit mask} of the hits, filled by the shading
+        rays = RayPacket(rays.pixels + pixel_offset, rays.origins, rays.directions, rays.throughput)
+        visibility = {}
+        self.hits.append((rays, surface, depth, visibility))
+
+        return visibility
+
+    def add_background(self, pixels, colors, pixel_offset=0):
+        np.add.at(self.background, pixels + pixel_offset, colors)
+
+
+class PacketTracer(object):
+    # wavefront version of ray.RayTracer: every stage (intersect, shade, spawn
+    # secondary rays) runs over the whole batch of rays of the same depth
+    def __init__(self, scene, options):
+        self._scene = scene
+        self._options = options
+
+        self._random = np.random.default_rng(options.get('seed', 0))
+        self.ray_counts = Counter()
+
+        # per pixel ray counts of the packet being traced when stats are enabled
+        self._cost = None
+
+        self._stats = stats.active
+        self._intersect = scene.intersect_packet
+        self._occluded = scene.occluded_packet
+        self._lighting = self.calculate_intensity
+        self._environment = self._background
+
+        if self._stats is not None:
+            self._intersect = self._stats.timed('intersect', self._intersect)
+            self._occluded = self._stats.timed('shadow', self._occluded)
+            self._lighting = self._stats.timed('lighting', self._lighting)
+            self._environment = self._stats.timed('envmap', self._environment)
+
+    def _count(self, kind, depth, rays):
+        counters = self._stats.counters
+        counters['rays', kind, depth] += len(rays)
+
+        if self._cost is not None:
+            self._cost += np.bincount(rays.pixels, minlength=len(self._cost))
+
+    def _background(self, directions):
+        if self._options['envmap']:
+            return self._scene.envmap_packet(directions)
+        return np.tile(np.array([0.2, 0.7, 0.8]), (len(directions), 1))
+
+    def _surface(self, rays, distances, objects, primitives):
+        count = len(rays)
+        points = rays.origins + rays.directions * distances[:, None]
+        normals = np.empty((count, 3))
+        materials = MaterialPacket.empty(count)
+
+        for index in np.unique(objects):
+            rows = np.nonzero(objects == index)[0]
+            obj_normals, obj_materials = self._scene.objects[index].surface_packet(points[rows], primitives[rows])
+
+            normals[rows] = obj_normals
+            materials.assign(rows, obj_materials)
+
+        return PacketSurface(points, normals, materials)
+
+    def calculate_intensity(self, rays, surface, depth=0, visibility=None):
+        # visibility, when given, maps light positions to the lit mask of the hits and
+        # saves the shadow rays of lights found in it
+        count = len(rays)
+
+        if not self._options['light']:
+            return np.ones(count), np.zeros(count)
+
+        light_intensity = np.zeros(count)
+        specular_light_intensity = np.zeros(count)
+
+        for light in self._scene.lights:
+            to_light = np.array(light.position.coordinates, dtype=float) - surface.points
+            light_distance = np.sqrt(utils.dot_packet(to_light, to_light))
+            light_dir = to_light / light_distance[:, None]
+
+            lit = np.ones(count, dtype=bool)
+
+            if self._options['shadow']:
+                position = tuple(light.position.coordinates)
+                lit = None if visibility is None else visibility.get(position)
+
+                if lit is None:
+                    shadow_origins = utils.build_origin_packet(surface.points, light_dir, surface.normals)
+                    lit = ~self._occluded(shadow_origins, light_dir, light_distance)
+                    self.ray_counts['shadow'] += count
+
+                    if visibility is not None:
+                        visibility[position] = lit
+
+                    if self._stats is not None:
+                        self._count('shadow', depth, rays)
+                        self._stats.counters['tests', 'shadow'] += count
+                        self._stats.counters['hits', 'shadow'] += count - int(lit.sum())
+
+            light_intensity += np.where(lit, light.intensity * np.maximum(0, utils.dot_packet(light_dir, surface.normals)), 0)
+
+            if self._options['specular_light']:
+                reflect_scalar = -utils.dot_packet(utils.reflect_packet(-light_dir, surface.normals), rays.directions)
+                reflect_scalar = np.maximum(0, reflect_scalar)
+
+                specular = np.power(reflect_scalar, surface.materials.specular_exponent) * light_intensity
+                specular_light_intensity += np.where(lit, specular, 0)
+
+        return light_intensity, specular_light_intensity
+
+    def _survivors(self, throughput, depth):
+        # same pruning and russian roulette as ray.RayTracer, returns (rows, throughput)
+        min_throughput = self._options.get('min_throughput', 0.0)
+        rows = np.arange(len(throughput))
+
+        if min_throughput is not None:
+            rows = np.nonzero(throughput > min_throughput)[0]
+            self.ray_counts['pruned'] += len(throughput) - len(rows)
+
+        throughput = throughput[rows]
+
+        if self._options.get('russian_roulette') and depth >= self._options.get('roulette_depth', 2):
+            survival = np.minimum(1.0, throughput)
+            alive = self._random.random(len(rows)) < survival
+
+            self.ray_counts['roulette'] += len(rows) - int(alive.sum())
+            rows, throughput = rows[alive], throughput[alive] / survival[alive]
+
+        return rows, throughput
+
+    def _reflected(self, rays, surface, depth):
+        rows, throughput = self._survivors(rays.throughput * surface.materials.albedo[:, 2], depth)
+
+        directions = utils.normalize_packet(utils.reflect_packet(rays.directions[rows], surface.normals[rows]))
+        origins = utils.build_origin_packet(surface.points[rows], directions, surface.normals[rows])
+
+        return RayPacket(rays.pixels[rows], origins, directions, throughput)
+
+    def _refracted(self, rays, surface, depth):
+        rows, throughput = self._survivors(rays.throughput * surface.materials.albedo[:, 3], depth)
+
+        directions = utils.refract_packet(rays.directions[rows], surface.normals[rows],
+                                          surface.materials.refractive_index[rows])
+        directions = utils.normalize_packet(directions)
+        origins = utils.build_origin_packet(surface.points[rows], directions, surface.normals[rows])
+
+        return RayPacket(rays.pixels[rows], origins, directions, throughput)
+
+    def _local(self, surface, light_intensity, specular_light_intensity):
+        albedo = surface.materials.albedo
+        local = surface.materials.diffuse_color * (light_intensity * albedo[:, 0])[:, None]
+        local += (specular_light_intensity * albedo[:, 1])[:, None]
+
+        return local
+
+    def shade(self, gbuffer):
+        # colors of all the pixels of a G-buffer under the current lights
+        colors = gbuffer.background.copy()
+        positions = {tuple(light.position.coordinates) for light in self._scene.lights}
+
+        for rays, surface, depth, visibility in gbuffer.hits:
+            # forget the shadows of positions no light is at anymore
+            for position in set(visibility) - positions:
+                del visibility[position]
+
+            light_intensity, specular_light_intensity = self._lighting(rays, surface, depth, visibility)
+            local = self._local(surface, light_intensity, specular_light_intensity)
+
+            np.add.at(colors, rays.pixels, local * rays.throughput[:, None])
+
+        return colors
+
+    def trace(self, origins, directions, cost=None, gbuffer=None, pixel_offset=0, ids=None):
+        # cost, when given, is a per ray array that receives the number of rays
+        # (secondary and shadow included) traced for it, only filled with stats enabled.
+        # With a gbuffer the hits and background are recorded in it as well, ray i
+        # belongs to pixel pixel_offset + i there. ids, when given, is a per ray array
+        # receiving the index of the object the ray hits, -1 where it misses
+        count = len(origins)
+        colors = np.zeros((count, 3))
+
+        rays = RayPacket(np.arange(count), origins, directions, np.ones(count))
+        kinds = [('camera', len(rays))]
+        depth = 0
+
+        self._cost = cost
+        if ids is not None:
+            ids[:] = -1
+
+        while len(rays):
+            if depth >= self._options['max_depth']:
+                # reached max recursive depth for reflection or refraction
+                background = self._environment(rays.directions) * rays.throughput[:, None]
+                np.add.at(colors, rays.pixels, background)
+
+                if gbuffer is not None:
+                    gbuffer.add_background(rays.pixels, background, pixel_offset)
+                break
+
+            self.ray_counts['rays'] += len(rays)
+            if self._stats is not None:
+                # packets of secondary rays are refracted rays followed by reflected ones
+                offset = 0
+                for kind, size in kinds:
+                    self._count(kind, depth, rays.take(slice(offset, offset + size)))
+                    offset += size
+
+            distances, objects, primitives = self._intersect(rays.origins, rays.directions)
+            if depth == 0 and ids is not None:
+                ids[:] = objects
+
+            missed = np.nonzero(objects < 0)[0]
+            if len(missed):
+                background = self._environment(rays.directions[missed]) * rays.throughput[missed, None]
+                np.add.at(colors, rays.pixels[missed], background)
+
+                if gbuffer is not None:
+                    gbuffer.add_background(rays.pixels[missed], background, pixel_offset)
+
+            hit = np.nonzero(objects >= 0)[0]
+            rays = rays.take(hit)
+            surface = self._surface(rays, distances[hit], objects[hit], primitives[hit])
+
+            visibility = None
+            if gbuffer is not None:
+                visibility = gbuffer.add_hits(rays, surface, depth, pixel_offset)
+
+            light_intensity, specular_light_intensity = self._lighting(rays, surface, depth, visibility)
+            local = self._local(surface, light_intensity, specular_light_intensity)
+
+            np.add.at(colors, rays.pixels, local * rays.throughput[:, None])
+
+            secondary = []
+            if self._options['refract']:
+                secondary.append(('refract', self._refracted(rays, surface, depth + 1)))
+            if self._options['reflect']:
+                secondary.append(('reflect', self._reflected(rays, surface, depth + 1)))
+
+            if not secondary:
+                break
+
+            kinds = [(kind, len(packet)) for kind, packet in secondary]
+            rays = RayPacket.concatenate([packet for _, packet in secondary])
+            depth += 1
+
+        self._cost = None
+
+        return colors
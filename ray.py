@@ -1,7 +1,11 @@
 import math
+import random
+
+from collections import Counter
 
 from entities import Vector3
 
+import stats
 import utils
 
 class RayIntersector(object):
@@ -22,14 +26,15 @@ class RayReflector(object):
     def _reflect(cls, v, normal):
         return utils.reflect(v, normal)
 
-    def calculate_reflection(self, origin, direction, intersection, depth):
+    def reflected_ray(self, direction, intersection):
+        # (origin, direction) of the reflected ray or None when reflections are off
         if not self._options['reflect']:
-            return Vector3()
+            return None
 
         reflect_dir = self._reflect(direction, intersection.normal).normalize()
         reflect_origin = utils.build_origin(intersection.point, reflect_dir, intersection.normal)
 
-        return self._tracer.trace(reflect_origin, reflect_dir, depth + 1)
+        return reflect_origin, reflect_dir
 
 
 class RayRefractor(object):
@@ -42,9 +47,9 @@ class RayRefractor(object):
     def _refract(self, v, normal, refractive_index):
         return utils.refract(v, normal, refractive_index)
 
-    def calculate_refraction(self, origin, direction, intersection, depth):
+    def refracted_ray(self, direction, intersection):
         if not self._options['refract']:
-            return Vector3()
+            return None
 
         refract_dir = self._refract(direction, 
                                     intersection.normal, 
@@ -53,14 +58,20 @@ class RayRefractor(object):
         refract_dir = refract_dir.normalize()
         refract_origin = utils.build_origin(intersection.point, refract_dir, intersection.normal)
 
-        return self._tracer.trace(refract_origin, refract_dir, depth + 1)
+        return refract_origin, refract_dir
 
 
 class LightIntensityCalculator(object):
-    def __init__(self, scene, options):
+    def __init__(self, tracer, scene, options):
+        self._tracer = tracer
         self._options = options
         self._scene = scene
 
+        self._stats = stats.active
+        self._occluded = scene.occluded
+        if self._stats is not None:
+            self._occluded = self._stats.timed('shadow', scene.occluded)
+
     def calculate_intensity(self, origin, direction, intersection, dept):
         light_intensity = 0
         specular_light_intensity = 0
@@ -69,16 +80,23 @@ class LightIntensityCalculator(object):
             return 1, 0
 
         for light in self._scene.lights:
-            light_dir = (light.position - intersection.point).normalize()
-            light_distance = (light.position - intersection.point).norm()
-            
+            light_dir = light.position - intersection.point
+            light_distance = light_dir.norm()
+            light_dir = light_dir.normalize()
+
             if self._options['shadow']:
                 shadow_origin = utils.build_origin(intersection.point, light_dir, intersection.normal)
-                shadow_intersection = self._scene.intersect(shadow_origin, light_dir)
+                occluded = self._occluded(shadow_origin, light_dir, light_distance)
+                self._tracer.ray_counts['shadow'] += 1
 
-                if shadow_intersection:
-                    if (shadow_intersection.point - shadow_origin).norm() < light_distance:
-                        continue
+                if self._stats is not None:
+                    counters = self._stats.counters
+                    counters['rays', 'shadow', dept] += 1
+                    counters['tests', 'shadow'] += 1
+                    counters['hits', 'shadow'] += occluded
+
+                if occluded:
+                    continue
             
             light_intensity += light.intensity * max(0, light_dir * intersection.normal)
 
@@ -94,6 +112,10 @@ class LightIntensityCalculator(object):
 
 
 class RayTracer(object):
+    # the ray tree is walked with an explicit queue instead of recursion. Every ray
+    # carries its throughput (product of the albedos along the way), so secondary rays
+    # that can't add anything visible (throughput <= min_throughput) are never traced
+    # and deep ones can be cut with russian roulette without biasing the image
     def __init__(self, scene, options):
         self._scene = scene
         self._options = options
@@ -103,35 +125,98 @@ class RayTracer(object):
         self._ray_reflector = RayReflector(self, scene, options)
         self._ray_refractor = RayRefractor(self, scene, options)
 
-        self._light_tracer = LightIntensityCalculator(scene, options)
+        self._light_tracer = LightIntensityCalculator(self, scene, options)
+
+        self._random = random.Random(options.get('seed', 0))
+        self.ray_counts = Counter()
+
+        # index of the object the camera ray of the last trace hit, -1 for none
+        self.primary_object = -1
+
+        # with stats enabled every stage goes through a timing wrapper, otherwise
+        # these are the plain bound methods
+        self._stats = stats.active
+        self._intersect = self._intersector.intersection
+        self._calculate_intensity = self._light_tracer.calculate_intensity
+        self._environment = self._background
+
+        if self._stats is not None:
+            self._intersect = self._stats.timed('intersect', self._intersect)
+            self._calculate_intensity = self._stats.timed('lighting', self._calculate_intensity)
+            self._environment = self._stats.timed('envmap', self._environment)
+
+    def _background(self, origin, direction):
+        if self._options['envmap']:
+            return self._scene.envmap(origin, direction)
+        return Vector3(0.2, 0.7, 0.8)
+
+    def _push(self, queue, ray, throughput, depth, kind):
+        if ray is None:
+            return
+
+        min_throughput = self._options.get('min_throughput', 0.0)
+        if min_throughput is not None and throughput <= min_throughput:
+            self.ray_counts['pruned'] += 1
+            return
+
+        if self._options.get('russian_roulette') and depth >= self._options.get('roulette_depth', 2):
+            survival = min(1.0, throughput)
+
+            if self._random.random() >= survival:
+                self.ray_counts['roulette'] += 1
+                return
+
+            throughput /= survival
+
+        queue.append((ray[0], ray[1], throughput, depth, kind))
 
     def trace(self, origin, direction, depth=0):
-        intersection = self._intersector.intersection(origin, direction)
+        color = Vector3()
+        queue = [(origin, direction, 1.0, depth, 'camera')]
+        ray_counts = self.ray_counts
+        collector = self._stats
+
+        self.primary_object = -1
+
+        while queue:
+            origin, direction, throughput, depth, kind = queue.pop()
+
+            if depth >= self._options['max_depth']:
+                # reached max recursive depth for relfection or refraction
+                color = color.madd(self._environment(origin, direction), throughput)
+                continue
+
+            ray_counts['rays'] += 1
+            if collector is not None:
+                collector.counters['rays', kind, depth] += 1
+
+            intersection = self._intersect(origin, direction)
+
+            if not intersection:
+                color = color.madd(self._environment(origin, direction), throughput)
+                continue
 
-        if depth >= self._options['max_depth'] or not intersection:
-            # no intersection detected or we have reached max recursive depth for relfection or refraction
-            if self._options['envmap']:
-                return self._scene.envmap(origin, direction) 
-            return Vector3(0.2, 0.7, 0.8)
+            if kind == 'camera':
+                self.primary_object = intersection.object_index
 
-        refraction = self._ray_refractor.calculate_refraction(origin, direction, intersection, depth)
-        reflection = self._ray_reflector.calculate_reflection(origin, direction, intersection, depth)
+            material = intersection.material
+            light_intensity, specular_light_intensity = self._calculate_intensity(origin, direction, intersection, depth)
 
-        light_intensity, specular_light_intensity = self._light_tracer.calculate_intensity(origin, direction, intersection, depth)
+            # resut vecotr - it's a material color
+            result_vector = material.diffuse_color
 
-        # resut vecotr - it's a material color
-        result_vector = intersection.material.diffuse_color
+            # apply light
+            result_vector = result_vector * light_intensity * material.albedo[0]
 
-        # apply light
-        result_vector = result_vector * light_intensity * intersection.material.albedo[0]
+            # add specular intensity
+            result_vector += Vector3(1, 1, 1) * specular_light_intensity * material.albedo[1]
 
-        # add specular intensity
-        result_vector += Vector3(1, 1, 1) * specular_light_intensity * intersection.material.albedo[1]
-        
-        # add reflection
-        result_vector += reflection * intersection.material.albedo[2]
+            color = color.madd(result_vector, throughput)
 
-        # add refraction
-        result_vector += refraction * intersection.material.albedo[3]
+            # reflection and refraction are added by the rays they spawn
+            self._push(queue, self._ray_reflector.reflected_ray(direction, intersection),
+                       throughput * material.albedo[2], depth + 1, 'reflect')
+            self._push(queue, self._ray_refractor.refracted_ray(direction, intersection),
+                       throughput * material.albedo[3], depth + 1, 'refract')
 
-        return result_vector
\ No newline at end of file
+        return color
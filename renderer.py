@@ -1,32 +1,109 @@
+import os
 import math
 import time
-import itertools
+import pickle
+import shutil
+import hashlib
+import tempfile
 
-from entities import Vector3
+from collections import Counter, deque
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from multiprocessing import shared_memory
+
+import numpy as np
+
+from entities import Camera
 from ray import RayTracer
+from packet import PacketTracer, GBuffer
+from checkpoint import Checkpoint
+
+import stats
+import writers
 
 class Frame(object):
-    __slots__ = ('width', 'height', 'buffer')
-    def __init__(self, width, height, buffer):
+    # the rendered image as a contiguous (height, width, 3) float32 HDR buffer. Display
+    # pixels are derived from it in one vectorized pass (exposure, tone mapping operator,
+    # clamp, gamma), so the same frame can be re-tonemapped without rendering it again
+    __slots__ = ('width', 'height', 'hdr', 'tone_mapping')
+
+    OPERATORS = ('clamp', 'reinhard')
+
+    def __init__(self, width, height, hdr=None, operator='clamp', exposure=1.0, gamma=1.0):
         self.width = width
         self.height = height
-        self.buffer = buffer
+        self.hdr = np.zeros((height, width, 3), dtype=np.float32) if hdr is None else hdr
+        self.tone_mapping = {}
+
+        self.set_tone_mapping(operator, exposure, gamma)
+
+    def set_tone_mapping(self, operator='clamp', exposure=1.0, gamma=1.0):
+        if operator not in self.OPERATORS:
+            raise ValueError("Unknown tone mapping operator: {}".format(operator))
+
+        self.tone_mapping = {'operator': operator, 'exposure': exposure, 'gamma': gamma}
+
+    @classmethod
+    def tonemap(cls, hdr, operator='clamp', exposure=1.0, gamma=1.0):
+        # float colors to uint8, values are truncated like int(255 * c) used to do
+        colors = np.asarray(hdr, dtype=np.float32)
+
+        if exposure != 1.0:
+            colors = colors * np.float32(exposure)
+        if operator == 'reinhard':
+            colors = colors / (1 + colors)
+
+        colors = np.clip(colors, 0, 1)
+        if gamma != 1.0:
+            colors **= np.float32(1.0 / gamma)
+
+        return (colors * 255).astype(np.uint8)
+
+    @property
+    def pixels(self):
+        return self.tonemap(self.hdr, **self.tone_mapping)
 
     @property
     def bytes(self):
-        for index in range(0, self.width * self.height, self.width):
-            line = self.buffer[index: index + self.width]
-            yield bytes(p for p in itertools.chain.from_iterable(line))
+        for line in self.pixels:
+            yield line.data
+
+    def save(self, filename):
+        # .ppm / .png are tone mapped, .pfm keeps the raw float values
+        if filename.lower().endswith('.pfm'):
+            writers.write_pfm(filename, self.hdr)
+            return
+
+        with writers.open_writer(filename, self.width, self.height) as writer:
+            writer.write_rows(self.pixels)
 
 class Renderer(object):
-    def __init__(self, width, height, options=None):
+    def __init__(self, width, height, options=None, camera=None):
         self._width = width
         self._height = height
 
+        self.camera = camera or Camera()
+
         self._fov_hor = 2 * math.atan(height / width)
         self._fov_vert = math.pi / 2 
 
         self._options = self._prepare_options(options)
+        self.ray_counts = Counter()
+        self.stats = None
+
+        self._gbuffer = None
+        self.budget_report = None
+
+        # (height, width) index of the object the camera ray of every pixel hit in the
+        # render going on, -1 for none; the anti aliasing edges are found with it
+        self._ids = None
+
+    def __getstate__(self):
+        # workers get size, camera and options; what the last render left behind (counts,
+        # stats, G-buffer, ids) is dropped, so the pickle only changes when those do
+        state = dict(self.__dict__)
+        state.update(ray_counts=Counter(), stats=None, _gbuffer=None, budget_report=None, _ids=None)
+
+        return state
 
     def _prepare_options(self, user_options):
         options = {
@@ -36,54 +113,933 @@ class Renderer(object):
             'shadow': True,
             'specular_light': True,
             'envmap': True,
-            'max_depth': 4
+            'max_depth': 4,
+            'engine': 'scalar',
+            'packet_size': 4096,
+            'workers': 1,
+            'tile_size': 32,
+            # secondary rays with throughput <= min_throughput are not traced (None traces all)
+            'min_throughput': 0.0,
+            'russian_roulette': False,
+            'roulette_depth': 2,
+            'seed': 0,
+            # collect ray / test counters, stage timers and a per pixel cost map into self.stats
+            'stats': False,
+            # how the HDR frame is turned into display pixels, see Frame.tonemap
+            'tonemap': 'clamp',
+            'exposure': 1.0,
+            'gamma': 1.0,
+            # keep the ray tree of the last render (packet engine, serial) and only shade it
+            # again while nothing but the lights changed
+            'gbuffer': False,
+            # adaptive anti aliasing: pixels on edges get aa_grid x aa_grid stratified samples
+            # more (0 turns it off), edges are where neighbours differ by more than
+            # aa_threshold in tone mapped colour (0..1) or hit another object
+            'aa_grid': 0,
+            'aa_threshold': 0.1,
+            # seconds render() may take, quality is lowered to fit it (None renders as asked)
+            'time_budget': None,
+            # directory keeping the finished tiles of a render, a render of the same scene
+            # with the same options picks up where a killed one stopped (None keeps nothing)
+            'checkpoint': None,
         }
         user_options = user_options or {}
         options.update(user_options)
 
         return options
 
-    def _create_frame(self):
-        frame = [None] * (self._width * self._height)
-        return frame
+    def _tone_mapping(self):
+        return {
+            'operator': self._options['tonemap'],
+            'exposure': self._options['exposure'],
+            'gamma': self._options['gamma'],
+        }
 
-    @classmethod
-    def _cast_vector_to_rgb_tuple(cls, v):
-        r = int(255 * max(0, min(1, v[0])))
-        g = int(255 * max(0, min(1, v[1])))
-        b = int(255 * max(0, min(1, v[2])))
+    def _create_frame(self, hdr=None):
+        return Frame(self._width, self._height, hdr, **self._tone_mapping())
 
-        return r, g, b
+    def _primary_direction(self, i, j):
+        y = - (2 * (j + 0.5) / self._height - 1) * math.tan(self._fov_hor / 2)
+        x = (2 * (i + 0.5) / self._width - 1) * math.tan(self._fov_vert / 2)
 
-    def render(self, scene):
-        start = time.time()
-        frame = self._create_frame()
+        return self.camera.direction(x, y)
+
+    def _primary_directions(self, x0, y0, x1, y1):
+        return self._pixel_directions(np.tile(np.arange(x0, x1), y1 - y0), np.repeat(np.arange(y0, y1), x1 - x0))
+
+    def _pixel_directions(self, columns, rows):
+        # directions through the centres of the pixels at (columns, rows)
+        x = (2 * (columns + 0.5) / self._width - 1) * math.tan(self._fov_vert / 2)
+        y = - (2 * (rows + 0.5) / self._height - 1) * math.tan(self._fov_hor / 2)
+
+        return self.camera.directions(x, y)
+
+    def _primary_origins(self, count):
+        return np.tile(np.array(self.camera.position.coordinates, dtype=float), (count, 1))
+
+    def _create_tracer(self, scene):
+        if self._options['engine'] == 'packet':
+            return PacketTracer(scene, self._options)
+        return RayTracer(scene, self._options)
+
+    def _band_tiles(self, y0, y1, step):
+        return [(x, y0, min(self._width, x + step), y1) for x in range(0, self._width, step)]
+
+    def _tiles(self):
+        size = self._options['tile_size']
+
+        return [
+            tile
+            for y in range(0, self._height, size)
+            for tile in self._band_tiles(y, min(self._height, y + size), size)
+        ]
+
+    def _render_tile(self, tracer, tile, cost=None, ids=None):
+        # returns the (height, width, 3) float32 colors of the tile; cost, when given, is a
+        # (height, width) array receiving the work spent on every pixel, ids one receiving
+        # the object hit through every pixel (-1 for none)
+        x0, y0, x1, y1 = tile
+
+        if self._options['engine'] == 'packet':
+            directions = self._primary_directions(x0, y0, x1, y1)
+            ray_cost = None if cost is None else np.zeros(len(directions))
+            ray_ids = None if ids is None else np.empty(len(directions), dtype=np.int32)
+
+            colors = tracer.trace(self._primary_origins(len(directions)), directions, ray_cost, ids=ray_ids)
+
+            if cost is not None:
+                cost += ray_cost.reshape(cost.shape)
+            if ids is not None:
+                ids[:] = ray_ids.reshape(ids.shape)
+            return colors.astype(np.float32).reshape(y1 - y0, x1 - x0, 3)
+
+        pixels = np.empty((y1 - y0, x1 - x0, 3), dtype=np.float32)
+        origin = self.camera.position
+
+        for j in range(y0, y1):
+            for i in range(x0, x1):
+                if cost is not None:
+                    start = time.perf_counter()
+
+                vector = tracer.trace(origin, self._primary_direction(i, j))
+                pixels[j - y0, i - x0] = vector.coordinates
+
+                if ids is not None:
+                    ids[j - y0, i - x0] = tracer.primary_object
+                if cost is not None:
+                    cost[j - y0, i - x0] += time.perf_counter() - start
+
+        return pixels
+
+    def _render_pixels(self, tracer, columns, rows, cost=None, ids=None):
+        # returns the (n, 3) float32 colors of the pixels at (columns, rows); cost and ids,
+        # when given, are (n,) arrays as for _render_tile
+        colors = np.empty((len(columns), 3), dtype=np.float32)
+
+        if self._options['engine'] == 'packet':
+            size = self._options['packet_size']
+
+            for start in range(0, len(columns), size):
+                end = min(len(columns), start + size)
+                directions = self._pixel_directions(columns[start:end], rows[start:end])
+
+                colors[start:end] = tracer.trace(self._primary_origins(end - start), directions,
+                                                 None if cost is None else cost[start:end],
+                                                 ids=None if ids is None else ids[start:end])
+            return colors
+
+        for index, (i, j) in enumerate(zip(columns.tolist(), rows.tolist())):
+            if cost is not None:
+                start = time.perf_counter()
+
+            colors[index] = tracer.trace(self.camera.position, self._primary_direction(i, j)).coordinates
+
+            if ids is not None:
+                ids[index] = tracer.primary_object
+            if cost is not None:
+                cost[index] += time.perf_counter() - start
+
+        return colors
+
+    def _edges(self, frame, ids):
+        # pixels differing from their right or lower neighbour, both of the pair are marked
+        display = Frame.tonemap(frame.hdr, **self._tone_mapping()).astype(np.float32) / 255
+        threshold = self._options['aa_threshold']
+        edges = np.zeros(ids.shape, dtype=bool)
+
+        across = (np.abs(display[:, 1:] - display[:, :-1]).max(axis=2) > threshold) | (ids[:, 1:] != ids[:, :-1])
+        edges[:, 1:] |= across
+        edges[:, :-1] |= across
+
+        across = (np.abs(display[1:] - display[:-1]).max(axis=2) > threshold) | (ids[1:] != ids[:-1])
+        edges[1:] |= across
+        edges[:-1] |= across
+
+        return edges
+
+    def _antialias_samples(self, frame, edges=None):
+        # the anti aliasing samples of a frame with one sample per pixel: every edge pixel
+        # gets one jittered sample in each cell of an aa_grid x aa_grid grid over it.
+        # Returns (rows, columns) of the edge pixels and (columns, rows) of the samples,
+        # grid * grid consecutive ones per edge pixel
+        grid = self._options['aa_grid']
+        if edges is None:
+            edges = self._edges(frame, self._ids)
+        rows, columns = np.nonzero(edges)
+
+        count = len(rows)
+        random = np.random.default_rng(self._options['seed'])
+        cells = np.arange(grid * grid)
+
+        # offsets from the pixel centre, (count, grid * grid)
+        x = (cells % grid + random.random((count, grid * grid))) / grid - 0.5
+        y = (cells // grid + random.random((count, grid * grid))) / grid - 0.5
+
+        return (rows, columns), ((columns[:, None] + x).ravel(), (rows[:, None] + y).ravel())
+
+    def _sample_chunks(self, count):
+        # slices splitting count samples into pieces of about a tile's worth of work
+        size = self._options['tile_size'] ** 2
+
+        return [slice(start, min(count, start + size)) for start in range(0, count, size)]
+
+    def _refine(self, frame, pixels, colors, cost=None):
+        # averages the colors of the anti aliasing samples into the edge pixels
+        rows, columns = pixels
+        count = len(rows)
+        grid = self._options['aa_grid']
+
+        colors = colors.reshape(count, grid * grid, 3).sum(axis=1)
+        frame.hdr[rows, columns] = (frame.hdr[rows, columns] + colors) / (grid * grid + 1)
+
+        if cost is not None:
+            self.stats.pixel_cost[rows, columns] += cost.reshape(count, -1).sum(axis=1)
+
+        self.ray_counts['samples'] += self._width * self._height + count * grid * grid
+        self.ray_counts['refined'] += count
+
+    def _antialias(self, scene, frame, edges=None, pool=None, update=None):
+        # refines a frame with one sample per pixel, see _antialias_samples. With a pool
+        # the samples are rendered by its workers, update as for _render_pool
+        pixels, (columns, rows) = self._antialias_samples(frame, edges)
+        cost = None if self.stats is None else np.zeros(len(columns))
+
+        if pool is None:
+            tracer = self._create_tracer(scene)
+            colors = self._render_pixels(tracer, columns, rows, cost)
+            self.ray_counts.update(tracer.ray_counts)
+        else:
+            colors = np.empty((len(columns), 3), dtype=np.float32)
+            futures = {pool.submit(_render_worker_pixels, columns[chunk], rows[chunk], update): chunk
+                       for chunk in self._sample_chunks(len(columns))}
+
+            for future in as_completed(futures):
+                chunk = futures[future]
+                colors[chunk], chunk_cost = self._collect_pixels(future.result())
+
+                if cost is not None:
+                    cost[chunk] = chunk_cost
+
+        self._refine(frame, pixels, colors, cost)
+
+    def _report_progress(self, proceesed_count, total_count, percent):
+        while ((proceesed_count / total_count) * 100) // 10 > percent:
+            percent += 1
+            print('#', end='', flush=True)
+
+        return percent
+
+    def _render_scalar(self, scene, frame):
         total_count = self._width * self._height
         proceesed_count = 0
         percent = 0
 
         ray_tracer = RayTracer(scene, self._options)
+        cost = None if self.stats is None else self.stats.pixel_cost
+        hdr, ids = frame.hdr, self._ids
 
-        print('RENDERING: [', end='', flush=True)
-        for j in range(self._height):
-            y = - (2 * (j + 0.5) / self._height - 1) * math.tan(self._fov_hor / 2)
+        origin = self.camera.position
 
+        for j in range(self._height):
             for i in range(self._width):
-                x = (2 * (i + 0.5) / self._width - 1) * math.tan(self._fov_vert / 2)
+                if cost is not None:
+                    start = time.perf_counter()
 
-                origin = Vector3(0, 0, 0)
-                direction = Vector3(x, y, -1).normalize()
+                vector = ray_tracer.trace(origin, self._primary_direction(i, j))
 
-                vector = ray_tracer.trace(origin, direction)
-
-                frame[i + j * self._width] = self._cast_vector_to_rgb_tuple(vector)
+                hdr[j, i] = vector.coordinates
+                ids[j, i] = ray_tracer.primary_object
                 proceesed_count += 1
-            
-            if ((proceesed_count / total_count) * 100) // 10 > percent:
-                percent += 1
-                print('#', end='', flush=True)
 
+                if cost is not None:
+                    cost[j, i] += time.perf_counter() - start
+
+            percent = self._report_progress(proceesed_count, total_count, percent)
+
+        self.ray_counts.update(ray_tracer.ray_counts)
+
+    def _render_packet(self, scene, frame):
+        total_count = self._width * self._height
+        percent = 0
+
+        packet_tracer = PacketTracer(scene, self._options)
+        rows_per_packet = max(1, self._options['packet_size'] // self._width)
+
+        for j in range(0, self._height, rows_per_packet):
+            tile = (0, j, self._width, min(self._height, j + rows_per_packet))
+            cost = None if self.stats is None else self.stats.pixel_cost[tile[1]:tile[3]]
+            frame.hdr[tile[1]:tile[3]] = self._render_tile(packet_tracer, tile, cost, self._ids[tile[1]:tile[3]])
+
+            percent = self._report_progress(tile[3] * self._width, total_count, percent)
+
+        self.ray_counts.update(packet_tracer.ray_counts)
+
+    def _gbuffer_key(self, scene):
+        # what the ray tree depends on: geometry, camera and the options shaping the tree
+        tree_options = ('reflect', 'refract', 'envmap', 'max_depth', 'min_throughput',
+                        'russian_roulette', 'roulette_depth', 'seed')
+
+        return (scene.geometry_key(), self._width, self._height, self.camera.key(),
+                tuple(self._options[name] for name in tree_options))
+
+    def _render_gbuffer(self, scene, frame):
+        packet_tracer = PacketTracer(scene, self._options)
+        key = self._gbuffer_key(scene)
+
+        if self._gbuffer is not None and self._gbuffer.key == key:
+            # light change only: shadow rays and shading, nothing else is traced
+            frame.hdr[:] = packet_tracer.shade(self._gbuffer).reshape(self._height, self._width, 3)
+            self._ids[:] = self._gbuffer.ids.reshape(self._height, self._width)
+            self.ray_counts.update(packet_tracer.ray_counts)
+            self._report_progress(1, 1, 0)
+            return
+
+        total_count = self._width * self._height
+        size = self._options['packet_size']
+        percent = 0
+
+        self._gbuffer = None
+        gbuffer = GBuffer(key, total_count)
+        directions = self._primary_directions(0, 0, self._width, self._height)
+        cost = None if self.stats is None else self.stats.pixel_cost.reshape(-1)
+        hdr = frame.hdr.reshape(-1, 3)
+
+        for start in range(0, total_count, size):
+            end = min(total_count, start + size)
+            ray_cost = None if cost is None else cost[start:end]
+
+            hdr[start:end] = packet_tracer.trace(self._primary_origins(end - start), directions[start:end],
+                                                 ray_cost, gbuffer, start, gbuffer.ids[start:end])
+
+            percent = self._report_progress(end, total_count, percent)
+
+        self._gbuffer = gbuffer
+        self._ids[:] = gbuffer.ids.reshape(self._height, self._width)
+        self.ray_counts.update(packet_tracer.ray_counts)
+
+    def _open_pool(self, scene):
+        # worker processes rendering tiles of scene into a shared frame, see _shared_views,
+        # returns (pool, shared memory); release both with _close_pool
+        workers = self._options['workers'] or os.cpu_count()
+
+        # build the lazy acceleration structures once, before the scene is shipped to the workers
+        scene.prepare()
+
+        shm = shared_memory.SharedMemory(create=True, size=self._width * self._height * (3 * 4 + 4))
+        try:
+            pool = ProcessPoolExecutor(max_workers=workers, initializer=_init_worker,
+                                       initargs=(self, scene, shm.name))
+        except BaseException:
+            shm.close()
+            shm.unlink()
+            raise
+
+        return pool, shm
+
+    def _shared_views(self, shm):
+        # (float32 hdr, int32 ids) of the frame in the shared memory of a pool
+        count = self._width * self._height
+
+        hdr = np.ndarray((self._height, self._width, 3), dtype=np.float32, buffer=shm.buf)
+        ids = np.ndarray((self._height, self._width), dtype=np.int32, buffer=shm.buf, offset=count * 3 * 4)
+
+        return hdr, ids
+
+    def _close_pool(self, pool, shm):
+        try:
+            pool.shutdown()
+        finally:
+            shm.close()
+            shm.unlink()
+
+    def _render_pool(self, pool, shm, frame, update=None):
+        # update brings the workers' scene to the frame being rendered, see _update_worker
+        tiles = self._tiles()
+        percent = 0
+
+        futures = [pool.submit(_render_worker_tile, tile, update) for tile in tiles]
+
+        for proceesed_count, future in enumerate(as_completed(futures), 1):
+            self._collect_tile(future.result())
+            percent = self._report_progress(proceesed_count, len(tiles), percent)
+
+        hdr, ids = self._shared_views(shm)
+        frame.hdr[:] = hdr
+        self._ids[:] = ids
+        del hdr, ids
+
+    def _render_serial(self, scene, frame):
+        if self._options['gbuffer']:
+            self._render_gbuffer(scene, frame)
+        elif self._options['engine'] == 'packet':
+            self._render_packet(scene, frame)
+        else:
+            self._render_scalar(scene, frame)
+
+    def _parallel(self):
+        # the G-buffer is kept by this process, it always renders serially
+        return self._options['workers'] != 1 and not self._options['gbuffer']
+
+    def _checkpoint_key(self, scene):
+        # what the pixels depend on: scene, lights, camera and every option except the
+        # ones only changing how the work is done
+        ignored = ('workers', 'stats', 'checkpoint', 'time_budget')
+
+        lights = tuple((tuple(light.position.coordinates), light.intensity) for light in scene.lights)
+        options = tuple(sorted((name, value) for name, value in self._options.items() if name not in ignored))
+        key = repr((scene.geometry_key(), lights, self._width, self._height, self.camera.key(), options))
+
+        return hashlib.blake2b(key.encode(), digest_size=16).hexdigest()
+
+    def _render_checkpointed(self, scene, frame, pool=None, shm=None):
+        # renders tile by tile into the checkpoint of the render, skipping the tiles a
+        # previous run already finished. The G-buffer is not used, tiles go to the
+        # workers of pool (see _open_pool) when there is one
+        checkpoint = Checkpoint(self._options['checkpoint'], self._checkpoint_key(scene), self._width, self._height)
+        tiles = self._tiles()
+        missing = [index for index in range(len(tiles)) if index not in checkpoint.done]
+        resumed = len(tiles) - len(missing)
+        percent = self._report_progress(resumed, len(tiles), 0)
+
+        if pool is not None:
+            hdr, ids = self._shared_views(shm)
+            futures = {pool.submit(_render_worker_tile, tiles[index]): index for index in missing}
+
+            for proceesed_count, future in enumerate(as_completed(futures), resumed + 1):
+                x0, y0, x1, y1 = tiles[futures[future]]
+                self._collect_tile(future.result())
+
+                checkpoint.hdr[y0:y1, x0:x1] = hdr[y0:y1, x0:x1]
+                checkpoint.ids[y0:y1, x0:x1] = ids[y0:y1, x0:x1]
+                checkpoint.mark(futures[future])
+                percent = self._report_progress(proceesed_count, len(tiles), percent)
+            del hdr, ids
+        else:
+            tracer = self._create_tracer(scene)
+
+            for proceesed_count, index in enumerate(missing, resumed + 1):
+                x0, y0, x1, y1 = tiles[index]
+                cost = None if self.stats is None else self.stats.pixel_cost[y0:y1, x0:x1]
+
+                checkpoint.hdr[y0:y1, x0:x1] = self._render_tile(tracer, tiles[index], cost,
+                                                                  checkpoint.ids[y0:y1, x0:x1])
+                checkpoint.mark(index)
+                percent = self._report_progress(proceesed_count, len(tiles), percent)
+
+            self.ray_counts.update(tracer.ray_counts)
+
+        frame.hdr[:] = checkpoint.hdr
+        self._ids[:] = checkpoint.ids
+        checkpoint.remove()
+        self.ray_counts['resumed'] += resumed
+
+    def _collect_tile(self, result):
+        # merges what a worker reports for a tile, returns (tile, pixels). pixels and ids
+        # are None when the worker wrote them to the shared frame
+        tile, pixels, ids, ray_counts, tile_stats, cost = result
+        x0, y0, x1, y1 = tile
+
+        if ids is not None and self._ids is not None:
+            self._ids[y0:y1, x0:x1] = ids
+
+        self.ray_counts.update(ray_counts)
+        if tile_stats is not None:
+            self.stats.merge(tile_stats)
+            if self.stats.pixel_cost.size:
+                self.stats.pixel_cost[y0:y1, x0:x1] += cost
+
+        return tile, pixels
+
+    def _collect_pixels(self, result):
+        # merges what a worker reports for a batch of pixels, returns (colors, cost)
+        colors, ray_counts, pixel_stats, cost = result
+
+        self.ray_counts.update(ray_counts)
+        if pixel_stats is not None:
+            self.stats.merge(pixel_stats)
+
+        return colors, cost
+
+    def _stream_serial(self, scene, writer):
+        tracer = self._create_tracer(scene)
+        band = self._options['tile_size']
+        percent = 0
+
+        for y0 in range(0, self._height, band):
+            y1 = min(self._height, y0 + band)
+
+            # the packet engine traces the band in chunks of about packet_size rays
+            if self._options['engine'] == 'packet':
+                step = max(1, self._options['packet_size'] // (y1 - y0))
+            else:
+                step = self._width
+
+            rows = np.empty((y1 - y0, self._width, 3), dtype=np.float32)
+            for tile in self._band_tiles(y0, y1, step):
+                rows[:, tile[0]:tile[2]] = self._render_tile(tracer, tile)
+
+            writer.write_rows(Frame.tonemap(rows, **self._tone_mapping()))
+            percent = self._report_progress(y1, self._height, percent)
+
+        self.ray_counts.update(tracer.ray_counts)
+
+    def _stream_parallel(self, scene, writer):
+        workers = self._options['workers'] or os.cpu_count()
+        band = self._options['tile_size']
+        bands = [(y, min(self._height, y + band)) for y in range(0, self._height, band)]
+        percent = 0
+
+        scene.prepare()
+
+        with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker, initargs=(self, scene)) as pool:
+            pending = deque()
+            submitted = 0
+
+            for _ in bands:
+                # keep the next band queued so workers don't idle while a band is written
+                while submitted < len(bands) and len(pending) < 2:
+                    y0, y1 = bands[submitted]
+                    pending.append((y0, y1, [pool.submit(_render_worker_tile, tile)
+                                             for tile in self._band_tiles(y0, y1, band)]))
+                    submitted += 1
+
+                y0, y1, futures = pending.popleft()
+                rows = np.empty((y1 - y0, self._width, 3), dtype=np.float32)
+
+                for future in futures:
+                    (x0, _, x1, _), pixels = self._collect_tile(future.result())
+                    rows[:, x0:x1] = pixels
+
+                writer.write_rows(Frame.tonemap(rows, **self._tone_mapping()))
+                percent = self._report_progress(y1, self._height, percent)
+
+    def _begin(self, pixel_cost=True, ids=True):
+        self.ray_counts = Counter()
+        self.stats = None
+        self._ids = np.full((self._height, self._width), -1, dtype=np.int32) if ids else None
+
+        if self._options['stats']:
+            self.stats = stats.RenderStats(*((self._width, self._height) if pixel_cost else (0, 0)))
+
+        stats.active = self.stats
+        print('RENDERING: [', end='', flush=True)
+
+    def _finish(self, start):
+        stats.active = None
         print(']')
-            
+
         print('[RENDER FINISHED options=%s] took: %.2f sec.' % (self._options, time.time() - start))
-        return Frame(self._width, self._height, frame)
+        print('[RAYS traced=%d shadow=%d pruned=%d roulette=%d]' % (
+            self.ray_counts['rays'], self.ray_counts['shadow'], self.ray_counts['pruned'], self.ray_counts['roulette']))
+        if self.ray_counts['resumed']:
+            print('[CHECKPOINT resumed tiles=%d]' % self.ray_counts['resumed'])
+        if self.ray_counts['samples']:
+            print('[ANTIALIAS samples=%d refined pixels=%d (%.1f%%)]' % (
+                self.ray_counts['samples'], self.ray_counts['refined'],
+                100.0 * self.ray_counts['refined'] / (self._width * self._height)))
+        if self.stats is not None:
+            print(self.stats.report())
+
+    # quality levels of time budgeted renders, best first: option overrides (max_depth
+    # is only ever lowered) and resolution scale
+    BUDGET_LEVELS = [
+        ({}, 1.0),
+        ({'max_depth': 3}, 1.0),
+        ({'max_depth': 2}, 1.0),
+        ({'max_depth': 2, 'specular_light': False}, 1.0),
+        ({'max_depth': 1, 'specular_light': False, 'shadow': False}, 1.0),
+        ({'max_depth': 1, 'specular_light': False, 'shadow': False}, 0.5),
+        ({'max_depth': 1, 'specular_light': False, 'shadow': False}, 0.25),
+    ]
+
+    # predictions are stretched by this much before they are compared with the budget
+    BUDGET_MARGIN = 1.2
+
+    def _budget_renderer(self, overrides, scale):
+        options = dict(self._options, time_budget=None, aa_grid=0, **overrides)
+        options['max_depth'] = min(self._options['max_depth'], options['max_depth'])
+
+        width, height = max(1, int(round(self._width * scale))), max(1, int(round(self._height * scale)))
+
+        return Renderer(width, height, options, self.camera)
+
+    def _probe(self, scene, columns, rows):
+        # renders a few pixels at full quality, returns (seconds, {(kind, depth): rays})
+        collector, stats.active = stats.active, stats.RenderStats()
+        try:
+            tracer = self._create_tracer(scene)
+
+            start = time.perf_counter()
+            self._render_pixels(tracer, columns, rows)
+
+            return time.perf_counter() - start, stats.active.rays()
+        finally:
+            stats.active = collector
+
+    def _render_budget(self, scene):
+        # times a full quality render of a sample of the pixels (one packet worth on the
+        # packet engine, 1% on the scalar one) and predicts every level of BUDGET_LEVELS
+        # from it, taking the time to be proportional to the rays the level traces: rays
+        # deeper than its max_depth and shadow rays when it has none are left out. The
+        # best level predicted to fit in what is left of the budget after preparing the
+        # scene and the probe is rendered, anti aliasing is added afterwards with the
+        # largest grid the time left allows
+        start = time.perf_counter()
+        budget = self._options['time_budget']
+
+        scene.prepare()
+
+        count = self._width * self._height
+        size = self._options['packet_size'] if self._options['engine'] == 'packet' else max(64, count // 100)
+        sample = np.random.default_rng(self._options['seed']).choice(count, min(count, size), replace=False)
+
+        seconds, rays = self._probe(scene, sample % self._width, sample // self._width)
+        workers = 1 if not self._parallel() else min(self._options['workers'] or os.cpu_count(), os.cpu_count())
+        ray_time = seconds / max(1, sum(rays.values())) * count / len(sample) / workers
+
+        # what the levels may spend, scene preparation and the probe are paid already
+        left = budget - (time.perf_counter() - start)
+
+        for level, (overrides, scale) in enumerate(self.BUDGET_LEVELS):
+            renderer = self._budget_renderer(overrides, scale)
+            options = renderer._options
+
+            level_rays = sum(number for (kind, depth), number in rays.items()
+                             if depth < options['max_depth'] and (kind != 'shadow' or options['shadow']))
+            predicted = ray_time * level_rays * scale * scale
+
+            if predicted * self.BUDGET_MARGIN <= left:
+                break
+
+        # the anti aliasing samples are traced here, not on the workers
+        sample_time = ray_time * workers * level_rays / count
+
+        frame = renderer.render(scene)
+        self.ray_counts, self.stats = renderer.ray_counts, renderer.stats
+
+        # anti aliasing with the largest grid that still fits
+        grid = self._options['aa_grid']
+        if grid:
+            edges = renderer._edges(frame, renderer._ids)
+
+            while grid and sample_time * edges.sum() * grid * grid * self.BUDGET_MARGIN > budget - (time.perf_counter() - start):
+                grid //= 2
+
+            if grid:
+                renderer._options['aa_grid'] = grid
+                renderer._antialias(scene, frame, edges)
+
+        if renderer._width != self._width or renderer._height != self._height:
+            rows = np.arange(self._height) * renderer._height // self._height
+            columns = np.arange(self._width) * renderer._width // self._width
+            frame = self._create_frame(np.ascontiguousarray(frame.hdr[rows][:, columns]))
+
+        self.budget_report = {
+            'budget': budget,
+            'elapsed': time.perf_counter() - start,
+            'predicted': predicted,
+            'level': level,
+            'scale': scale,
+            'max_depth': renderer._options['max_depth'],
+            'shadow': renderer._options['shadow'],
+            'specular_light': renderer._options['specular_light'],
+            'aa_grid': grid,
+        }
+        print('[BUDGET %.2f sec] took: %.2f sec. chosen: %s' % (
+            budget, self.budget_report['elapsed'],
+            ' '.join('%s=%s' % (name, self.budget_report[name])
+                     for name in ('level', 'scale', 'max_depth', 'shadow', 'specular_light', 'aa_grid'))))
+
+        return frame
+
+    def render(self, scene):
+        if self._options['time_budget'] is not None:
+            return self._render_budget(scene)
+
+        start = time.time()
+        frame = self._create_frame()
+
+        self._begin()
+        pool = shm = None
+        try:
+            # the pool stays open for the anti aliasing samples
+            if self._parallel():
+                pool, shm = self._open_pool(scene)
+
+            if self._options['checkpoint'] is not None:
+                self._render_checkpointed(scene, frame, pool, shm)
+            elif pool is not None:
+                self._render_pool(pool, shm, frame)
+            else:
+                self._render_serial(scene, frame)
+
+            if self._options['aa_grid']:
+                self._antialias(scene, frame, pool=pool)
+        finally:
+            if pool is not None:
+                self._close_pool(pool, shm)
+            self._finish(start)
+
+        return frame
+
+    def render_progressive(self, scene, callback=None, snapshot=None, steps=(4, 2, 1)):
+        # renders coarse to fine: each pass samples every step-th pixel in both directions,
+        # 1/16, then 1/4, then all of them with the default steps, and keeps the samples
+        # of the passes before. After every pass the frame, where pixels not sampled yet
+        # repeat the sample above and to the left of them, goes to callback(frame, step)
+        # and is saved to the snapshot file. The render stops after any pass for which
+        # callback returns False. The last pass is anti aliased when aa_grid is set.
+        # Returns the frame of the last pass
+        start = time.time()
+        total_count = self._width * self._height
+        percent = 0
+
+        hdr = np.zeros((self._height, self._width, 3), dtype=np.float32)
+        sampled = np.zeros((self._height, self._width), dtype=bool)
+        frame = None
+
+        self._begin()
+        tracer = self._create_tracer(scene)
+        try:
+            for step in steps:
+                grid = np.zeros_like(sampled)
+                grid[::step, ::step] = True
+
+                rows, columns = np.nonzero(grid & ~sampled)
+                cost = None if self.stats is None else np.zeros(len(rows))
+                ids = np.empty(len(rows), dtype=np.int32)
+
+                hdr[rows, columns] = self._render_pixels(tracer, columns, rows, cost, ids)
+                self._ids[rows, columns] = ids
+                sampled |= grid
+
+                if cost is not None:
+                    self.stats.pixel_cost[rows, columns] += cost
+                percent = self._report_progress(int(sampled.sum()), total_count, percent)
+
+                if sampled.all():
+                    frame = self._create_frame(hdr)
+                    if self._options['aa_grid']:
+                        self._antialias(scene, frame)
+                else:
+                    preview = np.repeat(np.repeat(hdr[::step, ::step], step, axis=0), step, axis=1)
+                    frame = self._create_frame(np.ascontiguousarray(preview[:self._height, :self._width]))
+
+                if snapshot is not None:
+                    # through a temporary file, a viewer never sees a half written image
+                    root, extension = os.path.splitext(snapshot)
+                    frame.save(root + '.partial' + extension)
+                    os.replace(root + '.partial' + extension, snapshot)
+
+                if callback is not None and callback(frame, step) is False:
+                    break
+        finally:
+            self.ray_counts.update(tracer.ray_counts)
+            self._finish(start)
+
+        return frame
+
+    def render_sequence(self, scene, frames, output):
+        # renders an animation. frames yields the changes of every frame over the one
+        # before it, a dict with any of
+        #     'camera': Camera
+        #     'objects': {index: {attribute: value}}
+        #     'lights': {index: {attribute: value}}
+        # and frame n is saved to output % n (e.g. 'output/frame_%04d.png'). Assets,
+        # acceleration structures and the worker pool are kept for the whole sequence,
+        # moved objects are refitted into the scene tree. Returns the written filenames
+        start = time.time()
+        filenames = []
+
+        pool = shm = updates = None
+        if self._parallel():
+            pool, shm = self._open_pool(scene)
+
+            # the changes of every frame are pickled once into this directory, tiles only
+            # carry the frame index and workers read the frames they haven't seen yet
+            updates = tempfile.mkdtemp(prefix='sequence_')
+
+        try:
+            for index, changes in enumerate(frames):
+                frame_start = time.time()
+                changes = changes or {}
+
+                if 'camera' in changes:
+                    self.camera = changes['camera']
+                scene.update(changes.get('objects'), changes.get('lights'))
+
+                if updates is not None:
+                    with open(os.path.join(updates, '%d.pickle' % index), 'wb') as f:
+                        pickle.dump(changes, f, pickle.HIGHEST_PROTOCOL)
+
+                frame = self._create_frame()
+
+                self._begin()
+                try:
+                    update = None
+                    if pool is not None:
+                        update = (updates, index)
+                        self._render_pool(pool, shm, frame, update)
+                    else:
+                        self._render_serial(scene, frame)
+
+                    if self._options['aa_grid']:
+                        self._antialias(scene, frame, pool=pool, update=update)
+                finally:
+                    self._finish(frame_start)
+
+                frame.save(output % index)
+                filenames.append(output % index)
+        finally:
+            if pool is not None:
+                self._close_pool(pool, shm)
+                shutil.rmtree(updates, ignore_errors=True)
+
+        elapsed = time.time() - start
+        print('[SEQUENCE FINISHED frames=%d] took: %.2f sec, %.2f sec per frame' % (
+            len(filenames), elapsed, elapsed / max(1, len(filenames))))
+
+        return filenames
+
+    def render_stream(self, scene, output):
+        # renders band by band (tile_size rows) straight into an image file, output is a
+        # filename (.ppm / .png) or an ImageWriter. Only a couple of bands are held in
+        # memory, so with stats enabled the per pixel cost map is not collected. Written
+        # rows can't be refined, anti aliasing (aa_grid) is not supported
+        if self._options['aa_grid']:
+            raise ValueError("render_stream can't anti alias, set aa_grid to 0")
+
+        start = time.time()
+        writer = writers.open_writer(output, self._width, self._height) if isinstance(output, str) else output
+
+        self._begin(pixel_cost=False, ids=False)
+        try:
+            with writer:
+                if self._options['workers'] != 1:
+                    self._stream_parallel(scene, writer)
+                else:
+                    self._stream_serial(scene, writer)
+        finally:
+            self._finish(start)
+
+
+# state of a tile render worker process, set up once by the pool initializer
+_worker = None
+
+
+def _init_worker(renderer, scene, shm_name=None):
+    # without shared memory the tile pixels are sent back with the result
+    global _worker
+
+    shm = pixels = ids = None
+    if shm_name is not None:
+        shm = shared_memory.SharedMemory(name=shm_name)
+        pixels, ids = renderer._shared_views(shm)
+
+    # each worker collects into its own stats, they are sent back tile by tile
+    stats.active = stats.RenderStats() if renderer._options['stats'] else None
+
+    _worker = (renderer, scene, renderer._create_tracer(scene), shm, pixels, ids)
+
+
+# frame of a sequence the worker's scene is at
+_worker_frame = -1
+
+
+def _update_worker(update):
+    # update is (directory, frame index), the changes of frame n are pickled in
+    # directory/n.pickle. The frames since the last one this worker rendered are merged
+    # and applied at once, so the scene is refitted once however many were skipped
+    global _worker_frame
+
+    directory, index = update
+    if index == _worker_frame:
+        return
+
+    camera = None
+    objects, lights = {}, {}
+
+    for frame in range(_worker_frame + 1, index + 1):
+        with open(os.path.join(directory, '%d.pickle' % frame), 'rb') as f:
+            changes = pickle.load(f)
+
+        camera = changes.get('camera', camera)
+        for changed, frame_changes in ((objects, changes.get('objects')), (lights, changes.get('lights'))):
+            for item, attributes in (frame_changes or {}).items():
+                changed.setdefault(item, {}).update(attributes)
+
+    renderer, scene = _worker[:2]
+    if camera is not None:
+        renderer.camera = camera
+    scene.update(objects, lights)
+
+    _worker_frame = index
+
+
+def _render_worker_tile(tile, update=None):
+    if update is not None:
+        _update_worker(update)
+
+    renderer, _, tracer, _, pixels, ids = _worker
+    x0, y0, x1, y1 = tile
+
+    cost = None if stats.active is None else np.zeros((y1 - y0, x1 - x0))
+    tile_ids = np.empty((y1 - y0, x1 - x0), dtype=np.int32)
+
+    tile_pixels = renderer._render_tile(tracer, tile, cost, tile_ids)
+    if pixels is not None:
+        pixels[y0:y1, x0:x1] = tile_pixels
+        ids[y0:y1, x0:x1] = tile_ids
+        tile_pixels = tile_ids = None
+    elif not renderer._options['aa_grid']:
+        # nothing is anti aliased, the ids don't need to travel
+        tile_ids = None
+
+    return (tile, tile_pixels, tile_ids) + _worker_counts(tracer) + (cost,)
+
+
+def _render_worker_pixels(columns, rows, update=None):
+    # colors of the pixels at (columns, rows), which may be anywhere inside pixels
+    if update is not None:
+        _update_worker(update)
+
+    renderer, _, tracer = _worker[:3]
+    cost = None if stats.active is None else np.zeros(len(columns))
+
+    colors = renderer._render_pixels(tracer, columns, rows, cost)
+
+    return (colors,) + _worker_counts(tracer) + (cost,)
+
+
+def _worker_counts(tracer):
+    # (ray counts, stats) collected since the last call, handed back to the parent
+    collector = stats.active
+
+    ray_counts, tracer.ray_counts = tracer.ray_counts, Counter()
+    worker_stats = None
+    if collector is not None:
+        worker_stats = stats.RenderStats()
+        worker_stats.merge(collector)
+        collector.reset()
+
+    return ray_counts, worker_stats
@@ -1,15 +1,29 @@
-import sys
-import math
+import numpy as np
 
-from entities import Material, Vector3
-from entities.objects import SceneIntersectionObject
+from entities.bvh import BVH
+from entities.envmap import EnvironmentMap
+
+import stats
 
 class Scene(object):
-    def __init__(self, envmap):
+    def __init__(self, envmap, far=1000, bvh_min_objects=8):
+        # a PIL image is decoded once into an EnvironmentMap
+        if envmap is not None and not isinstance(envmap, EnvironmentMap):
+            envmap = EnvironmentMap(envmap)
+
         self._envmap = envmap
         self._objects = []
         self._lights = []
 
+        # rays don't see anything farther than this
+        self.far = far
+
+        # below this many objects a plain loop is cheaper than walking a tree
+        self._bvh_min_objects = bvh_min_objects
+        self._bvh = None
+        self._bvh_objects = None
+        self._unbounded_objects = None
+
     @property
     def lights(self):
         return self._lights
@@ -20,32 +34,251 @@ class Scene(object):
 
     def add_object(self, obj):
         self._objects.append(obj)
+        self._bvh = self._bvh_objects = self._unbounded_objects = None
 
     def add_light(self, light_obj):
         self._lights.append(light_obj)
 
+    def _build_bvh(self):
+        # objects with finite bounds go into the tree, the rest is tested for every ray
+        bounded, unbounded, lower, upper = [], [], [], []
+
+        for index, obj in enumerate(self._objects):
+            bbox = obj.get_bbox()
+
+            if bbox is None:
+                unbounded.append(index)
+                continue
+
+            bounded.append(index)
+            lower.append(bbox[0].coordinates)
+            upper.append(bbox[1].coordinates)
+
+        self._bvh_objects = bounded
+        self._unbounded_objects = unbounded
+
+        if len(bounded) >= self._bvh_min_objects:
+            self._bvh = BVH(lower, upper, leaf_size=2)
+            self._bvh_lower = np.array(lower, dtype=float)
+            self._bvh_upper = np.array(upper, dtype=float)
+        else:
+            self._bvh = None
+            self._unbounded_objects = list(range(len(self._objects)))
+
+    def refit(self, indices):
+        # the objects at indices moved: their new bounds are refitted into the scene tree,
+        # which is only built again when an object lost or gained finite bounds
+        if self._bvh is None:
+            # not built yet, or too few objects to need one
+            return
+
+        positions = {index: position for position, index in enumerate(self._bvh_objects)}
+
+        for index in indices:
+            bbox = self._objects[index].get_bbox()
+
+            if (bbox is None) != (index not in positions):
+                self._bvh = self._bvh_objects = self._unbounded_objects = None
+                return
+
+            if bbox is not None:
+                self._bvh_lower[positions[index]] = bbox[0].coordinates
+                self._bvh_upper[positions[index]] = bbox[1].coordinates
+
+        self._bvh.refit(self._bvh_lower, self._bvh_upper)
+
+    def update(self, objects=None, lights=None):
+        # sets attributes of objects and lights, both given as {index: {attribute: value}},
+        # and refits the scene tree around the objects that changed
+        for index, changes in (lights or {}).items():
+            for name, value in changes.items():
+                setattr(self._lights[index], name, value)
+
+        for index, changes in (objects or {}).items():
+            for name, value in changes.items():
+                setattr(self._objects[index], name, value)
+
+        if objects:
+            self.refit(list(objects))
+
+    def geometry_key(self):
+        # everything rays see except the lights, a render can reuse what it traced
+        # for as long as this stays the same
+        envmap = self._envmap.key() if self._envmap is not None else None
+
+        return self.far, envmap, tuple(obj.geometry_key() for obj in self._objects)
+
+    def prepare(self):
+        # builds every lazy acceleration structure up front
+        for obj in self._objects:
+            obj.prepare()
+
+        self._ensure_bvh()
+
+    def _ensure_bvh(self):
+        if self._unbounded_objects is None:
+            self._build_bvh()
+
     def intersect(self, origin, direction):
+        self._ensure_bvh()
+
+        objects = self._objects
+        collector = stats.active
         result = None
-        distance = 1000 # sys.maxsize
 
-        for obj in self._objects:
-            intersection = obj.ray_intersect(origin, direction)
+        def leaf_intersect(indices, t_max):
+            result = None
 
-            if not intersection or intersection.distance >= distance:
-                continue
+            for index in indices:
+                # objects only report hits closer than the best one so far
+                hit = objects[index].ray_intersect(origin, direction, 0, t_max)
+
+                if hit is None:
+                    continue
+
+                t_max = hit[0]
+                result = hit[0], index, hit[1]
+
+            if collector is not None:
+                collector.counters['tests', 'object'] += len(indices)
+                collector.counters['hits', 'object'] += result is not None
+
+            return (t_max, result) if result else None
 
-            distance = intersection.distance
-            result = intersection
+        distance = self.far
 
-        return result
+        if self._bvh is not None:
+            bvh_objects = self._bvh_objects
+            result = self._bvh.intersect(origin.coordinates, direction.coordinates,
+                                         lambda primitives, t_max: leaf_intersect([bvh_objects[p] for p in primitives], t_max),
+                                         t_max=distance)
+            if result:
+                distance = result[0]
+
+        hit = leaf_intersect(self._unbounded_objects, distance)
+        if hit:
+            result = hit[1]
+
+        if result is None:
+            return None
+
+        # surface data is computed for the winning hit only
+        distance, index, primitive = result
+        intersection = objects[index].surface_at(origin, direction, distance, primitive)
+        intersection.object_index = index
+
+        return intersection
+
+    def occluded(self, origin, direction, max_distance):
+        # any-hit query for shadow rays: is there anything closer than max_distance
+        self._ensure_bvh()
+
+        max_distance = min(max_distance, self.far)
+        objects = self._objects
+
+        def leaf_occluded(indices, t_max):
+            for index in indices:
+                if objects[index].occluded(origin, direction, t_max):
+                    return True
+
+            return False
+
+        if self._bvh is not None:
+            bvh_objects = self._bvh_objects
+            if self._bvh.occluded(origin.coordinates, direction.coordinates,
+                                  lambda primitives, t_max: leaf_occluded([bvh_objects[p] for p in primitives], t_max),
+                                  max_distance):
+                return True
+
+        return leaf_occluded(self._unbounded_objects, max_distance)
 
     def envmap(self, origin, direction):
-        width, height = self._envmap.width, self._envmap.height
+        return self._envmap.sample(direction)
+
+    def _objects_intersect_packet(self, indices, origins, directions, distances=None):
+        # nearest hit among the given objects closer than distances, primitives are
+        # (object index, primitive) pairs
+        count = len(origins)
+        distances = np.full(count, np.inf) if distances is None else distances.copy()
+        primitives = np.full((count, 2), -1, dtype=np.int64)
+
+        for index in indices:
+            obj_distances, obj_primitives = self._objects[index].ray_intersect_packet(origins, directions, distances)
+
+            closer = obj_distances < distances
+
+            distances[closer] = obj_distances[closer]
+            primitives[closer, 0] = index
+            primitives[closer, 1] = obj_primitives[closer]
+
+        distances[primitives[:, 0] < 0] = np.inf
+
+        return distances, primitives
+
+    def intersect_packet(self, origins, directions):
+        # returns (distances, object indices, primitives); object index is -1 where the ray misses
+        self._ensure_bvh()
+
+        count = len(origins)
+        distances = np.full(count, float(self.far))
+        objects = np.full(count, -1, dtype=np.int64)
+        primitives = np.zeros(count, dtype=np.int64)
+
+        if self._bvh is not None:
+            bvh_objects = np.array(self._bvh_objects, dtype=np.int64)
+
+            bvh_distances, hits = self._bvh.intersect_packet(
+                origins, directions,
+                lambda indices, o, d, t_max: self._objects_intersect_packet(bvh_objects[indices], o, d, t_max),
+                t_max=distances)
+
+            if hits.ndim == 2:
+                objects, primitives = hits[:, 0].copy(), hits[:, 1].copy()
+                distances = np.where(objects >= 0, bvh_distances, distances)
+
+        unbounded_distances, hits = self._objects_intersect_packet(self._unbounded_objects, origins, directions, distances)
+
+        closer = hits[:, 0] >= 0
+        distances[closer] = unbounded_distances[closer]
+        objects[closer] = hits[closer, 0]
+        primitives[closer] = hits[closer, 1]
+
+        primitives[objects < 0] = 0
+        distances[objects < 0] = np.inf
+
+        return distances, objects, primitives
+
+    def occluded_packet(self, origins, directions, max_distances):
+        self._ensure_bvh()
+
+        max_distances = np.minimum(max_distances, self.far)
+        objects = self._objects
+
+        def leaf_occluded(indices, origins, directions, t_max):
+            occluded = np.zeros(len(origins), dtype=bool)
+
+            for index in indices:
+                rays = np.nonzero(~occluded)[0]
+                if not len(rays):
+                    break
+
+                occluded[rays] = objects[index].occluded_packet(origins[rays], directions[rays], t_max[rays])
+
+            return occluded
+
+        occluded = np.zeros(len(origins), dtype=bool)
+
+        if self._bvh is not None:
+            bvh_objects = np.array(self._bvh_objects, dtype=np.int64)
+            occluded = self._bvh.occluded_packet(
+                origins, directions,
+                lambda indices, o, d, t_max: leaf_occluded(bvh_objects[indices], o, d, t_max),
+                max_distances)
 
-        direction = direction.normalize()
+        rays = np.nonzero(~occluded)[0]
+        occluded[rays] = leaf_occluded(self._unbounded_objects, origins[rays], directions[rays], max_distances[rays])
 
-        x = int((math.atan2(direction.z, direction.x) / (2 * math.pi) + 0.5) * width)
-        y = int(math.acos(direction.y) / math.pi * height)
+        return occluded
 
-        r, g, b = self._envmap.getpixel((x, y))
-        return Vector3(r / 255, g / 255, b / 255)
+    def envmap_packet(self, directions):
+        return self._envmap.sample_packet(directions)
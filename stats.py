@@ -0,0 +1,114 @@
+import time
+
+from collections import Counter
+
+import numpy as np
+
+
+# collector the hot paths report to; None (the default) turns instrumentation off and
+# costs a single attribute lookup per instrumented call
+active = None
+
+
+class RenderStats(object):
+    # counters are keyed by tuples: ('rays', kind, depth) for traced rays,
+    # ('tests', what) / ('hits', what) for intersection tests, ('rejections', 'bbox')
+    # for culled boxes. timers hold the seconds spent per stage. pixel_cost is the
+    # (height, width) work per pixel: seconds on the scalar engine, rays on the packet one
+    __slots__ = ('counters', 'timers', 'pixel_cost')
+
+    # stages timed inside another one: shadow rays are traced while lighting a hit, so
+    # the lighting timer includes them
+    NESTED = {'shadow': 'lighting'}
+
+    def __init__(self, width=0, height=0):
+        self.counters = Counter()
+        self.timers = Counter()
+        self.pixel_cost = np.zeros((height, width))
+
+    def timed(self, stage, function):
+        # wraps function so every call adds its duration to the stage timer
+        timers = self.timers
+        perf_counter = time.perf_counter
+
+        def timed_function(*args):
+            start = perf_counter()
+            try:
+                return function(*args)
+            finally:
+                timers[stage] += perf_counter() - start
+
+        return timed_function
+
+    def merge(self, other):
+        self.counters.update(other.counters)
+        self.timers.update(other.timers)
+
+    def reset(self):
+        # in place, the timing wrappers keep a reference to the timers
+        self.counters.clear()
+        self.timers.clear()
+
+    def rays(self):
+        # {(kind, depth): count}
+        return {key[1:]: count for key, count in self.counters.items() if key[0] == 'rays'}
+
+    def as_dict(self):
+        return {
+            'counters': {'.'.join(str(part) for part in key): count for key, count in sorted(self.counters.items())},
+            'timers': dict(self.timers),
+        }
+
+    def report(self):
+        lines = ['[STATS]']
+
+        rays = self.rays()
+        for kind in sorted({kind for kind, _ in rays}):
+            by_depth = ' '.join('d%d=%d' % (depth, rays[kind, depth]) for _, depth in sorted(k for k in rays if k[0] == kind))
+            lines.append('  rays %-10s %10d  %s' % (kind, sum(rays[k] for k in rays if k[0] == kind), by_depth))
+
+        for what in sorted(key[1] for key in self.counters if key[0] == 'tests'):
+            tests = self.counters['tests', what]
+            line = '  tests %-9s %10d' % (what, tests)
+
+            if ('hits', what) in self.counters:
+                hits = self.counters['hits', what]
+                line += '  hits=%d (%.1f%%)' % (hits, 100.0 * hits / tests if tests else 0)
+            if ('rejections', what) in self.counters:
+                rejections = self.counters['rejections', what]
+                line += '  rejected=%d (%.1f%%)' % (rejections, 100.0 * rejections / tests if tests else 0)
+
+            lines.append(line)
+
+        # nested stages are listed under their parent, which also shows its own time
+        for stage, seconds in sorted(self.timers.items(), key=lambda item: -item[1]):
+            if stage in self.NESTED and self.NESTED[stage] in self.timers:
+                continue
+
+            nested = sorted(((child, self.timers[child]) for child, parent in self.NESTED.items()
+                             if parent == stage and child in self.timers), key=lambda item: -item[1])
+            line = '  time %-10s %10.3fs' % (stage, seconds)
+
+            if nested:
+                line += '  self=%.3fs' % (seconds - sum(child_seconds for _, child_seconds in nested))
+            lines.append(line)
+
+            for child, child_seconds in nested:
+                lines.append('    time %-8s %10.3fs  (part of %s)' % (child, child_seconds, stage))
+
+        return '\n'.join(lines)
+
+
+def write_heatmap(filename, cost):
+    # per pixel cost as a black - red - yellow - white PPM, scaled so the 99th percentile
+    # is white and a few outliers don't wash out the rest of the image
+    cost = np.asarray(cost, dtype=float)
+    scale = np.percentile(cost, 99) if cost.size else 0
+    level = np.clip(cost / scale, 0, 1) if scale > 0 else np.zeros_like(cost)
+
+    colors = np.stack((np.clip(3 * level, 0, 1), np.clip(3 * level - 1, 0, 1), np.clip(3 * level - 2, 0, 1)), axis=-1)
+    pixels = (255 * colors).astype(np.uint8)
+
+    with open(filename, 'wb') as f:
+        f.write('P6\n{} {}\n255\n'.format(cost.shape[1], cost.shape[0]).encode())
+        f.write(pixels.tobytes())
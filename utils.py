@@ -1,21 +1,21 @@
 import math
 
+import numpy as np
+
 from entities import Vector3
 
 def build_origin(point, direction, normal):
-    if direction * normal < 0:
-        origin = point - normal * 1e-3
-    else:
-        origin = point + normal * 1e-3
+    if direction.dot(normal) < 0:
+        return point.madd(normal, -1e-3)
 
-    return origin
+    return point.madd(normal, 1e-3)
 
 
 def reflect(v, normal):
-    return v - normal * 2 * (v * normal)
+    return v.reflect(normal)
 
 def refract(v, normal, refractive_index):
-    cos_v = - max(-1.0, min(1.0, v * normal))
+    cos_v = - max(-1.0, min(1.0, v.dot(normal)))
     etav, etat = 1, refractive_index
 
     if cos_v < 0:
@@ -24,19 +24,60 @@ def refract(v, normal, refractive_index):
         normal = -normal
     
     eta = etav / etat
-    k = 1 - eta * eta * (1 - cos_v ** 2)
+    k = 1 - eta * eta * (1 - cos_v * cos_v)
 
     if k < 0:
-        res_vector = Vector3(1, 0, 0)
-    else:
-        res_vector = v * eta + normal * (eta * cos_v - math.sqrt(k))
-    
-    return res_vector
+        return Vector3(1, 0, 0)
+
+    return (v * eta).madd(normal, eta * cos_v - math.sqrt(k))
 
 
 def cross(v1: Vector3, v2: Vector3) -> Vector3:
-    x = v1._coordinates[1] * v2._coordinates[2] - v1._coordinates[2] * v2._coordinates[1]
-    y = v1._coordinates[2] * v2._coordinates[0] - v1._coordinates[0] * v2._coordinates[2]
-    z = v1._coordinates[0] * v2._coordinates[1] - v1._coordinates[1] * v2._coordinates[0]
+    return v1.cross(v2)
+
+
+def dot_packet(a, b):
+    return a[..., 0] * b[..., 0] + a[..., 1] * b[..., 1] + a[..., 2] * b[..., 2]
+
+
+def cross_packet(a, b):
+    x = a[..., 1] * b[..., 2] - a[..., 2] * b[..., 1]
+    y = a[..., 2] * b[..., 0] - a[..., 0] * b[..., 2]
+    z = a[..., 0] * b[..., 1] - a[..., 1] * b[..., 0]
+
+    return np.stack((x, y, z), axis=-1)
+
+
+def normalize_packet(v):
+    norm = np.sqrt(dot_packet(v, v))
+    norm[norm == 0] = 1
+
+    return v / norm[:, None]
 
-    return Vector3(x, y, z)
\ No newline at end of file
+
+def build_origin_packet(points, directions, normals):
+    sign = np.where(dot_packet(directions, normals) < 0, -1e-3, 1e-3)
+    return points + normals * sign[:, None]
+
+
+def reflect_packet(v, normals):
+    return v - normals * (2 * dot_packet(v, normals))[:, None]
+
+
+def refract_packet(v, normals, refractive_index):
+    cos_v = -np.clip(dot_packet(v, normals), -1.0, 1.0)
+    etav = np.ones_like(cos_v)
+    etat = np.asarray(refractive_index, dtype=float) * etav
+
+    inside = cos_v < 0
+    cos_v = np.where(inside, -cos_v, cos_v)
+    etav, etat = np.where(inside, etat, etav), np.where(inside, etav, etat)
+    normals = np.where(inside[:, None], -normals, normals)
+
+    eta = etav / etat
+    k = 1 - eta * eta * (1 - cos_v ** 2)
+
+    res_vector = v * eta[:, None] + normals * (eta * cos_v - np.sqrt(np.maximum(k, 0)))[:, None]
+    res_vector[k < 0] = (1, 0, 0)
+
+    return res_vector
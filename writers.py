@@ -0,0 +1,125 @@
+import os
+import zlib
+import struct
+
+import numpy as np
+
+
+class ImageWriter(object):
+    # writes an image top to bottom, a band of rows at a time, so the whole image never
+    # has to be in memory. Rows are (rows, width, 3) uint8 arrays
+    def __init__(self, filename, width, height):
+        self.filename = filename
+        self.width = width
+        self.height = height
+        self.rows_written = 0
+
+        self._file = open(filename, 'wb')
+        self._write_header()
+
+    def _write_header(self):
+        pass
+
+    def _write_rows(self, pixels):
+        raise NotImplementedError
+
+    def _write_footer(self):
+        pass
+
+    def write_rows(self, pixels):
+        pixels = np.ascontiguousarray(pixels, dtype=np.uint8)
+
+        if pixels.shape[1:] != (self.width, 3):
+            raise ValueError("Expected rows of shape (n, {}, 3), got {}".format(self.width, pixels.shape))
+        if self.rows_written + len(pixels) > self.height:
+            raise ValueError("Writing past the last row of a {}x{} image".format(self.width, self.height))
+
+        self._write_rows(pixels)
+        self.rows_written += len(pixels)
+
+    def close(self):
+        if self._file.closed:
+            return
+
+        try:
+            if self.rows_written != self.height:
+                raise ValueError("Only {} of {} rows were written".format(self.rows_written, self.height))
+
+            self._write_footer()
+        finally:
+            self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            # leave the partial file behind without masking the original error
+            self._file.close()
+
+
+class PPMWriter(ImageWriter):
+    def _write_header(self):
+        self._file.write('P6\n{} {}\n255\n'.format(self.width, self.height).encode())
+
+    def _write_rows(self, pixels):
+        self._file.write(pixels.data)
+
+
+class PNGWriter(ImageWriter):
+    # 8 bit RGB, every row with filter type 0, compressed incrementally into IDAT chunks
+    SIGNATURE = b'\x89PNG\r\n\x1a\n'
+
+    def __init__(self, filename, width, height, compression=6):
+        self._compressor = zlib.compressobj(compression)
+        super(PNGWriter, self).__init__(filename, width, height)
+
+    def _chunk(self, kind, data):
+        self._file.write(struct.pack('>I', len(data)))
+        self._file.write(kind)
+        self._file.write(data)
+        self._file.write(struct.pack('>I', zlib.crc32(data, zlib.crc32(kind))))
+
+    def _write_header(self):
+        self._file.write(self.SIGNATURE)
+        self._chunk(b'IHDR', struct.pack('>IIBBBBB', self.width, self.height, 8, 2, 0, 0, 0))
+
+    def _write_rows(self, pixels):
+        rows = np.zeros((len(pixels), 1 + self.width * 3), dtype=np.uint8)
+        rows[:, 1:] = pixels.reshape(len(pixels), -1)
+
+        data = self._compressor.compress(rows.data)
+        if data:
+            self._chunk(b'IDAT', data)
+
+    def _write_footer(self):
+        self._chunk(b'IDAT', self._compressor.flush())
+        self._chunk(b'IEND', b'')
+
+
+def write_pfm(filename, hdr):
+    # raw float32 RGB as a portable float map: little endian, rows bottom to top
+    hdr = np.asarray(hdr, dtype='<f4')
+    height, width = hdr.shape[:2]
+
+    with open(filename, 'wb') as f:
+        f.write('PF\n{} {}\n-1.0\n'.format(width, height).encode())
+        for row in hdr[::-1]:
+            f.write(np.ascontiguousarray(row).data)
+
+
+WRITERS = {
+    '.ppm': PPMWriter,
+    '.png': PNGWriter,
+}
+
+
+def open_writer(filename, width, height):
+    extension = os.path.splitext(filename)[1].lower()
+
+    if extension not in WRITERS:
+        raise ValueError("Unsupported image format: {}".format(extension))
+
+    return WRITERS[extension](filename, width, height)